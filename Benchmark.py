@@ -0,0 +1,284 @@
+"""
+Offline benchmark of the sync, to compare the performance of the scripts run to run without touching MangaDex :
+    - a fake MangaDex (api and M@H nodes) answers in the process, through the transport of the ClientPool, with a configurable
+      latency, bandwidth, page size and proportion of 429 and 5xx
+    - the whole pipeline is run in a temporary folder : new sync, update (no new chapters), Verify mode (incremental and full) and Converter.py
+    - each step reports its time, pages/s, MB/s, the requests by endpoint and the peak RSS of the process
+      (and the json file also gets the metrics of the sync, see Metrics.py)
+ex : python Benchmark.py --mangas 4 --chapters 50 --pages 20 --page-size 300000 --latency 0.05 --json run.json
+"""
+
+import os # IO (chdir, walk)
+import sys # platform
+import json # json handling
+import asyncio # fake server and sync
+import argparse # settings of the benchmark
+import hashlib # filenames of the pages (with their hash, like M@H)
+import random # injected errors
+import shutil # removal of the temporary folder
+import tempfile # folder of the archive
+from time import perf_counter, time
+from collections import Counter # requests by endpoint
+import httpx # fake transport
+from rich import print # pretty print
+from rich.progress import Progress
+from rich.table import Table
+from Globals import SIMULTANEOUS_MANGAS, SIMULTANEOUS_REQUESTS, SIMULTANEOUS_PAGES, CHUNK_SIZE, ADAPTIVE_CONCURRENCY
+from Network import ClientPool, RateLimiter
+from Index import ArchiveIndex
+import Storage
+try: # not available on Windows
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss() -> float:
+    """peak resident memory of the process, in MB (0 if unknown)"""
+    if resource is None:
+        return 0.0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024**2 if sys.platform == "darwin" else rss / 1024 # bytes on macOS, KB on Linux
+
+
+class FakeMangaDex:
+    """
+    stand-in for api.mangadex.org and the M@H nodes (handler of a httpx.MockTransport)
+        - /manga/{id}/feed and /chapter : chapters of the fake mangas (paginated like the api)
+        - /at-home/server/{id} : a node among nodes, pages named with their SHA-256 like on M@H
+        - /data/{hash}/{page} and /data-saver/{hash}/{page} : pages of pageSize bytes, sent at bandwidth bytes/s
+          (every page of the first badNodes nodes is a 503, uploads.mangadex.org always answers)
+        - /report : reports of the pages to M@H
+    """
+    def __init__(self, mangas: int, chapters: int, pages: int, pageSize: int, latency: float = 0.0, bandwidth: float = 0.0,
+                 rate429: float = 0.0, rate5xx: float = 0.0, retryAfter: int = 1, nodes: int = 4, badNodes: int = 0) -> None:
+        self.mangas = [f"manga-{i}" for i in range(mangas)]
+        self.chapters = chapters
+        self.pages = pages
+        self.latency = latency
+        self.bandwidth = bandwidth # bytes/s of each page (0 : unlimited)
+        self.rate429 = rate429
+        self.rate5xx = rate5xx
+        self.retryAfter = retryAfter
+        self.nodes = nodes
+        self.badNodes = badNodes
+        self.updatedAt = "2000-01-01T00:00:00+00:00"
+        self._blob = random.Random(0).randbytes(max(pageSize - 64, 0)) # content shared by the pages (the page key makes them different)
+        self.requests = Counter() # endpoint : number of requests
+        self.errors = Counter() # 429 / 5xx : number of responses
+
+    def manga_json(self, idManga: str) -> dict:
+        return {"id": idManga, "type": "manga", "attributes": {"title": {"en": f"Bench {idManga}"}}}
+
+    def chapter_json(self, idManga: str, n: int) -> dict:
+        return {
+            "id": f"{idManga}-c{n}",
+            "type": "chapter",
+            "attributes": {"volume": str(n // 10 + 1), "chapter": str(n), "title": f"Chapter {n}", "updatedAt": self.updatedAt},
+            "relationships": [{"type": "manga", "id": idManga}, {"type": "scanlation_group", "attributes": {"name": "bench"}}]
+        }
+
+    def page_content(self, key: str) -> bytes:
+        return key.encode().ljust(64, b" ") + self._blob
+
+    def page_filename(self, key: str) -> str:
+        return f"{key}-{hashlib.sha256(self.page_content(key)).hexdigest()}.png"
+
+    @staticmethod
+    def paginate(data: list, request: httpx.Request) -> dict:
+        offset = int(request.url.params.get("offset", 0))
+        limit = int(request.url.params.get("limit", 100))
+        return {"result": "ok", "data": data[offset:offset+limit], "limit": limit, "offset": offset, "total": len(data)}
+
+    async def body(self, content: bytes):
+        """page sent by chunks at the bandwidth of the node"""
+        for i in range(0, len(content), CHUNK_SIZE):
+            chunk = content[i:i+CHUNK_SIZE]
+            if self.bandwidth:
+                await asyncio.sleep(len(chunk) / self.bandwidth)
+            yield chunk
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        parts = path.strip("/").split("/")
+        if parts[0] in ("data", "data-saver"):
+            endpoint = "pages" if request.url.host != "uploads.mangadex.org" else "uploads"
+        elif parts[0] == "manga" and parts[-1] == "feed":
+            endpoint = "/manga/{id}/feed"
+        elif parts[0] == "at-home":
+            endpoint = "/at-home/server"
+        else:
+            endpoint = path
+        self.requests[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        # injected errors
+        draw = random.random()
+        if draw < self.rate429 and endpoint != "pages":
+            self.errors["429"] += 1
+            return httpx.Response(429, headers={"X-RateLimit-Remaining": "0", "Retry-After": str(self.retryAfter)})
+        if endpoint == "/report":
+            return httpx.Response(200, json={"result": "ok"})
+        if endpoint == "pages" and request.url.host.startswith("node") and int(request.url.host[4:].split(".")[0]) < self.badNodes:
+            self.errors["bad node"] += 1
+            return httpx.Response(503)
+        if draw < self.rate429 + self.rate5xx:
+            self.errors["5xx"] += 1
+            return httpx.Response(503)
+
+        if endpoint == "/manga/{id}/feed":
+            idManga = parts[1]
+            if "updatedAtSince" in request.url.params and request.url.params["updatedAtSince"] >= self.updatedAt[:19]:
+                return httpx.Response(200, json=self.paginate([], request))
+            return httpx.Response(200, json=self.paginate([self.chapter_json(idManga, n) for n in range(self.chapters)], request))
+        if endpoint == "/chapter": # discovery of the update mode (nothing new since the first sync)
+            return httpx.Response(200, json=self.paginate([], request))
+        if endpoint == "/manga":
+            return httpx.Response(200, json=self.paginate([self.manga_json(m) for m in self.mangas], request))
+        if endpoint == "/at-home/server":
+            idChapter = parts[-1]
+            filenames = [self.page_filename(f"{idChapter}-p{p}") for p in range(self.pages)]
+            return httpx.Response(200, json={"result": "ok", "baseUrl": f"https://node{int(idChapter.rsplit('c', 1)[1]) % self.nodes}.bench",
+                                             "chapter": {"hash": idChapter, "data": filenames, "dataSaver": filenames}})
+        if endpoint in ("pages", "uploads"):
+            key = parts[-1].rsplit("-", 1)[0]
+            return httpx.Response(200, content=self.body(self.page_content(key)))
+        return httpx.Response(404)
+
+
+class Step:
+    """measures of a step of the benchmark"""
+    def __init__(self, name: str, server: FakeMangaDex) -> None:
+        self.name = name
+        self.server = server
+        self.result = {}
+
+    def __enter__(self):
+        self._requests = Counter(self.server.requests)
+        self._errors = Counter(self.server.errors)
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = perf_counter() - self._start
+        self.result = {
+            "step": self.name,
+            "seconds": round(seconds, 3),
+            "requests": dict(self.server.requests - self._requests),
+            "errors": dict(self.server.errors - self._errors),
+            "peak_rss_mb": round(peak_rss(), 1),
+        }
+
+    def pages(self, pages: int, nbytes: int):
+        seconds = max(self.result["seconds"], 1e-9)
+        self.result.update({
+            "pages": pages,
+            "mb": round(nbytes / 1024**2, 2),
+            "pages_per_s": round(pages / seconds, 1),
+            "mb_per_s": round(nbytes / 1024**2 / seconds, 2),
+        })
+
+
+def archive_size() -> tuple[int, int]:
+    """(number of pages, bytes) of the pages saved in the index"""
+    import Sync
+    return Sync.index.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages WHERE status = 'done'").fetchone()
+
+def run(args) -> tuple[list[dict], dict]:
+    """runs every step in a temporary folder, output : (measures of each step, metrics of the sync and update)"""
+    import Sync # (after chdir : FOLDER_PATH and LOGIN_PATH are relative to the working directory)
+    import Converter
+    server = FakeMangaDex(args.mangas, args.chapters, args.pages, args.page_size, args.latency, args.bandwidth,
+                          args.rate_429, args.rate_5xx, args.retry_after, args.nodes, args.bad_nodes)
+    # the real limits of the api are used only with --real-limits (else the benchmark measures the rate limiter)
+    limiter = RateLimiter() if args.real_limits else RateLimiter(10**6, 10**8)
+    Sync.open_session(False, args.simultaneous_mangas, args.simultaneous_chapters, args.simultaneous_pages,
+                      ClientPool(limiter=limiter, transport=httpx.MockTransport(server.handler)), args.adaptive)
+    Sync.prgbar = Progress(disable=True)
+    mangas = [server.manga_json(m) for m in server.mangas]
+    steps = []
+
+    async def network_steps():
+        try:
+            with Step("sync", server) as step:
+                await Sync.sync_mangas(mangas, args.layout, 1)
+            step.pages(*archive_size())
+            steps.append(step.result)
+            with Step("update", server) as step:
+                await Sync.sync_mangas(Sync.library(), update=True)
+            steps.append(step.result)
+        finally:
+            await Sync.close_session()
+    asyncio.run(network_steps())
+
+    Sync.index = ArchiveIndex()
+    folders = Sync.library()
+    with Step("verify", server) as step: # only the pages changed since their download are hashed
+        Sync.verify_library(folders)
+    steps.append(step.result)
+    Sync.index.db.execute("UPDATE pages SET mtime = NULL") # every page is hashed again
+    with Step("verify (full)", server) as step:
+        Sync.verify_library(folders)
+    step.pages(*archive_size())
+    steps.append(step.result)
+    Sync.index.close()
+
+    toSys = (args.layout + 1) % len(Storage.FILE_SYSTEMS)
+    with Step(f"convert {args.layout} -> {toSys}", server) as step:
+        moved = 0
+        for m in folders:
+            Converter.Journal(os.path.join(Sync.FOLDER_PATH, m, "convert.journal")).start(args.layout, toSys)
+            moved += Converter.convert_manga(m, args.layout, toSys, False)
+    steps.append(step.result)
+    step.result["pages"] = moved
+    step.result["pages_per_s"] = round(moved / max(step.result["seconds"], 1e-9), 1)
+    return steps, Sync.metrics.report()
+
+def report(steps: list[dict]):
+    table = Table(title="Benchmark")
+    for column in ("step", "seconds", "pages", "pages/s", "MB/s", "requests", "errors", "peak RSS (MB)"):
+        table.add_column(column)
+    for s in steps:
+        table.add_row(s["step"], str(s["seconds"]), str(s.get("pages", "")), str(s.get("pages_per_s", "")), str(s.get("mb_per_s", "")),
+                      ", ".join(f"{k} : {v}" for k, v in s["requests"].items()), ", ".join(f"{k} : {v}" for k, v in s["errors"].items()),
+                      str(s["peak_rss_mb"]))
+    print(table)
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="offline benchmark of Sync.py, Verify mode and Converter.py")
+    parser.add_argument("--mangas", type=int, default=2, help="fake mangas")
+    parser.add_argument("--chapters", type=int, default=20, help="chapters by manga")
+    parser.add_argument("--pages", type=int, default=20, help="pages by chapter")
+    parser.add_argument("--page-size", type=int, default=200_000, help="bytes by page")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before each response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bytes/s of each page download (0 : unlimited)")
+    parser.add_argument("--rate-429", type=float, default=0, help="proportion of api requests answered by a 429")
+    parser.add_argument("--rate-5xx", type=float, default=0, help="proportion of requests answered by a 503")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of the 429 (seconds)")
+    parser.add_argument("--nodes", type=int, default=4, help="M@H nodes given by /at-home/server")
+    parser.add_argument("--bad-nodes", type=int, default=0, help="M@H nodes answering a 503 to every page")
+    parser.add_argument("--real-limits", action="store_true", help="use the rate limits of MangaDex")
+    parser.add_argument("--layout", type=int, choices=(0, 1, 2), default=1, help="file system of the sync (converted to the next one)")
+    parser.add_argument("--simultaneous-mangas", type=int, default=SIMULTANEOUS_MANGAS)
+    parser.add_argument("--simultaneous-chapters", type=int, default=SIMULTANEOUS_REQUESTS)
+    parser.add_argument("--simultaneous-pages", type=int, default=SIMULTANEOUS_PAGES)
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, default=ADAPTIVE_CONCURRENCY)
+    parser.add_argument("--json", help="file where the measures are saved (to compare runs)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary archive")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    folder = tempfile.mkdtemp(prefix="mangadex-bench-")
+    cwd = os.getcwd()
+    os.chdir(folder)
+    try:
+        steps, metrics = run(args)
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(folder, ignore_errors=True)
+    report(steps)
+    if args.json:
+        with open(args.json, "w", encoding="UTF-8") as file:
+            json.dump({"time": time(), "settings": vars(args), "steps": steps, "metrics": metrics}, file, indent=2)
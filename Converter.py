@@ -1,140 +1,260 @@
 """
-Script to use if you want to convert between the 2 file systems (in one way or another) :
+Script to use if you want to convert between the 3 file systems (in one way or another) :
     - {vol}/{chap}/{page}.* : easier to browse, harder to read
     - {vol}/{chap}-{page}.* : easier to read, harder to browse
+    - {vol}/{chap}.cbz : one file by chapter (pages packed in an uncompressed zip)
     - automatically remove old system and pass existant files if already in place
+    - pages are moved (os.replace, no copy, except to pack or unpack a cbz) and every move is written in a journal before it is done,
+      so an interrupted conversion can be resumed or rolled back at the next launch
+    - the pages to move are found with one os.scandir by volume, and the mangas are converted in parallel processes
 """
 
 import os # IO (mkdir/makedirs, remove)
 import json # json handling
+from concurrent.futures import ProcessPoolExecutor, as_completed # mangas converted in parallel
 from rich import print # pretty print 
 from rich.progress import * # progress bar
-from Globals import __AUTHOR__, __VERSION__, FOLDER_PATH, format_title
-
-print("============================================")
-print("File system converter :")
-print("\t- This converter uses the infos.json file to gather infos about the settings of the folder")
-print("\t- You [bold red]do not[/bold red] need to edit this file")
-print("\t- Incomplete archives can be used but [bold red]aren't recommended[/bold red] (can cause problems)")
-print("\t- Please don't stop the conversion while in execution as it will break the folder")
-print(f"\t\tBy {__AUTHOR__}, v{__VERSION__}")
-print("============================================")
-# choice of mangas to convert
-folderList = [f for f in os.listdir(os.path.join(FOLDER_PATH)) if os.path.isdir(os.path.join(FOLDER_PATH, f)) and "infos.json" in os.listdir(os.path.join(FOLDER_PATH, f))]
-if not folderList: # if no folders have been found
-    print("No mangas found in working directory !")
-    exit()
-print("Manga choice :")
-for i in range(len(folderList)):
-    print(f"\t{i} : {folderList[i]}")
-print("============================================")
-mChoice = input(f"Choice (all if empty) (space between values): ")
-if not mChoice:
-    titlelist = folderList
-else:
+from Globals import __AUTHOR__, __VERSION__, FOLDER_PATH, CONVERT_WORKERS
+from Index import ArchiveIndex # paths of the pages are updated in the index
+import Storage # pages in folders or cbz
+
+class Journal:
+    """moves of a conversion (old path, new path), written before they are done"""
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+
+    def start(self, fromSys: int, toSys: int):
+        with io.open(self.path, "w", encoding="UTF-8") as file:
+            file.write(json.dumps({"from": fromSys, "to": toSys}) + "\n")
+
+    def add(self, moves: list):
+        """writes the moves of a chapter (on disk before any of them is done)"""
+        with io.open(self.path, "a", encoding="UTF-8") as file:
+            file.write(json.dumps(moves) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def read(self) -> tuple[dict, list]:
+        """output : (header {"from", "to"}, every move written)"""
+        with io.open(self.path, "r", encoding="UTF-8") as file:
+            lines = file.read().splitlines()
+        moves = []
+        for line in lines[1:]:
+            try:
+                moves.extend(json.loads(line))
+            except json.JSONDecodeError: # line cut by the interruption : none of its moves were done
+                break
+        return json.loads(lines[0]), moves
+
+    def close(self):
+        os.remove(self.path)
+
+def apply_moves(moves: list, index: ArchiveIndex):
+    """moves the pages (can be applied again after an interruption : moves already done are passed)"""
+    folders = set()
+    packed = [] # page files removed once their cbz is closed
+    unpacked = set() # cbz removed once their pages are extracted
+    for (old, new) in moves:
+        if not Storage.exists(old):
+            continue
+        (oldCbz, newCbz) = (Storage.cbz_entry(old), Storage.cbz_entry(new))
+        if Storage.exists(new): # already in place
+            pass
+        elif newCbz:
+            Storage.pack(old, new)
+        elif oldCbz:
+            Storage.unpack(old, new)
+        else:
+            if os.path.dirname(new) not in folders: # create folder
+                os.makedirs(os.path.dirname(new), exist_ok=True)
+                folders.add(os.path.dirname(new))
+            os.replace(old, new) # rename only (same file system)
+        if oldCbz:
+            unpacked.add(oldCbz[0])
+        elif os.path.exists(old):
+            packed.append(old)
+        index.move_page(old, new)
+        folders.add(os.path.dirname(old))
+    for (_, new) in moves:
+        Storage.close_chapter(new) # central directory of the cbz
+    for old in packed:
+        os.remove(old)
+    for cbz in unpacked:
+        os.remove(cbz)
+    # remove the chapter folders left empty
+    for folder in folders:
+        try:
+            os.rmdir(folder)
+        except OSError: # not empty (or a cbz)
+            pass
+    index.commit()
+
+def scan_volumes(name: str, fileFormat: str, fromSys: int, toSys: int) -> list:
+    """
+    moves needed to convert the pages of a manga from the file system fromSys to toSys, grouped by chapter
+    (one os.scandir by volume, and by chapter folder or cbz, no chapters.json needed)
+    """
+    ext = f".{fileFormat}"
+    chaptersPath = os.path.join(FOLDER_PATH, name, "chapters")
     try:
-        titlelist = [folderList[int(i)] for i in mChoice.split(" ")]
-    except Exception:
-        print("[bold red]Invalid choice[/bold red]")
-        exit()
-# for each manga
-for m in titlelist:
-    print(f"[bold blue]{m}[/bold blue]")
+        volumes = [entry for entry in os.scandir(chaptersPath) if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
+    def target(volPath: str, chapName: str, page: str) -> str:
+        if toSys == Storage.CBZ:
+            return os.path.join(volPath, f"{chapName}.cbz", f"page-{page}{ext}")
+        if toSys:
+            return os.path.join(volPath, f"{chapName}-p{page}{ext}")
+        return os.path.join(volPath, chapName, f"page-{page}{ext}")
+
+    plan = []
+    for vol in volumes:
+        chapters = {} # chap-{chap}-{title} : moves
+        if fromSys == Storage.CBZ: # FROM {vol}/{chap}.cbz
+            for cbz in os.scandir(vol.path):
+                if not (cbz.name.startswith("chap-") and cbz.name.endswith(".cbz") and cbz.is_file()):
+                    continue
+                chapName = cbz.name[:-len(".cbz")]
+                for img in Storage.cbz_pages(cbz.path):
+                    page = img[len("page-"):-len(ext)]
+                    if img.startswith("page-") and img.endswith(ext) and page.isdigit():
+                        chapters.setdefault(chapName, []).append((os.path.join(cbz.path, img), target(vol.path, chapName, page)))
+        elif fromSys: # FROM {vol}/{chap}-{page}.*
+            for img in os.scandir(vol.path):
+                if not (img.name.startswith("chap-") and img.name.endswith(ext) and "-p" in img.name and img.is_file()):
+                    continue
+                chapName, page = img.name[:-len(ext)].rsplit("-p", 1)
+                if page.isdigit():
+                    chapters.setdefault(chapName, []).append((img.path, target(vol.path, chapName, page)))
+        else: # FROM {vol}/{chap}/{page}.*
+            for chapFolder in os.scandir(vol.path):
+                if not (chapFolder.is_dir() and chapFolder.name.startswith("chap-")):
+                    continue
+                for img in os.scandir(chapFolder.path):
+                    page = img.name[len("page-"):-len(ext)]
+                    if img.name.startswith("page-") and img.name.endswith(ext) and page.isdigit():
+                        chapters.setdefault(chapFolder.name, []).append((img.path, target(vol.path, chapFolder.name, page)))
+        plan.extend(chapters.values())
+    return plan
+
+def convert_manga(*args) -> int:
+    """
+    called for each manga (in a worker process), moves its pages to the file system fsChoice and saves it in infos.json
+    args:
+        - m : str : folder of the manga
+        - cfsChoice : int : current file system
+        - fsChoice : int : file system to convert to
+        - resume : bool : if the moves of an interrupted conversion must be done first
+
+    output : int : number of pages moved
+    """
+    (m, cfsChoice, fsChoice, resume) = args
+    index = ArchiveIndex()
+    journal = Journal(os.path.join(FOLDER_PATH, m, "convert.journal"))
     with io.open(os.path.join(FOLDER_PATH, m, "infos.json"), "r", encoding="UTF-8") as file:
         mangaInfos = json.load(file)
-
-    idManga = mangaInfos["id"]
     name = mangaInfos["name"]
     fileFormat = ("png" if int(mangaInfos["format"]) else "jpg")
-    print(f"Format : {fileFormat}")
-    cfsChoice = int(mangaInfos["fileSys"])
-    fsChoice = 0 if cfsChoice else 1
-    
-    (cfs, fs) = ("vol/chap-page.*", "vol/chap/page.*") if cfsChoice else ("vol/chap/page.*", "vol/chap-page.*")
-    print(f"Current file system : [bold green]{cfs}[/bold green]")
-    confirm = input(f"\tFile system to convert to : {fs} \n\tIs this correct (y/N) ? ")
-    if confirm != "y":
-        print(f"[bold red]Conversion of {m} cancelled[/bold red]")
-        continue
 
+    moved = 0
+    if resume:
+        moves = journal.read()[1]
+        apply_moves(moves, index)
+        moved += len(moves)
+    for moves in scan_volumes(name, fileFormat, cfsChoice, fsChoice):
+        journal.add(moves) # written before the moves, so they can be resumed or rolled back
+        apply_moves(moves, index)
+        moved += len(moves)
+    # the new file system is saved once every page has been moved
     mangaInfos["fileSys"] = fsChoice
     with io.open(os.path.join(FOLDER_PATH, m, "infos.json"), "w", encoding="UTF-8") as file:
         json.dump(mangaInfos, file)
-            
-
-    with io.open(f"{FOLDER_PATH}/{name}/chapters.json", "r", encoding="UTF-8") as file:
-        chapters = json.load(file)
-        # sort the list from the json to make loading of images in order
-        chapters.sort(key=lambda c: (float(c["attributes"]["chapter"]) 
-                                    if c["attributes"]["chapter"] != None 
-                                    else 0))                            
-        n = 'aaaaa'                           
-        for c in chapters:
-            ni = c["attributes"]["chapter"]
-            if ni == n:
-                chapters.remove(c)
-            else:
-                n = ni
-
-    print("[italic]Replacing images...[/italic]")
-    # for each chapter
-    # create progress bar for chapters 
-    prgbar = Progress()
-    prgbar.start()
-    idTask = prgbar.add_task(name, total=len(chapters))
-    for c in chapters:
-        # chapter infos
-        vol = c["attributes"]["volume"]
-        chap = c["attributes"]["chapter"]
-        id = c["id"]
+    index.add_manga(mangaInfos["id"], name, fsChoice, int(mangaInfos["format"]), mangaInfos.get("lastSync", ""))
+    index.close()
+    journal.close()
+    return moved
+
+if __name__ == "__main__": # (the worker processes only import the functions above)
+    print("============================================")
+    print("File system converter :")
+    print("\t- This converter uses the infos.json file to gather infos about the settings of the folder")
+    print("\t- You [bold red]do not[/bold red] need to edit this file")
+    print("\t- Incomplete archives can be used but [bold red]aren't recommended[/bold red] (can cause problems)")
+    print("\t- If the conversion is stopped, it can be resumed or rolled back at the next launch")
+    print(f"\t\tBy {__AUTHOR__}, v{__VERSION__}")
+    print("============================================")
+    # choice of mangas to convert
+    folderList = [f for f in os.listdir(os.path.join(FOLDER_PATH)) if os.path.isdir(os.path.join(FOLDER_PATH, f)) and "infos.json" in os.listdir(os.path.join(FOLDER_PATH, f))]
+    if not folderList: # if no folders have been found
+        print("No mangas found in working directory !")
+        exit()
+    print("Manga choice :")
+    for i in range(len(folderList)):
+        print(f"\t{i} : {folderList[i]}")
+    print("============================================")
+    mChoice = input(f"Choice (all if empty) (space between values): ")
+    if not mChoice:
+        titlelist = folderList
+    else:
         try:
-            if not c["attributes"]["title"]:
-                title = "NoTitle"
-            title = format_title(c["attributes"]["title"])
+            titlelist = [folderList[int(i)] for i in mChoice.split(" ")]
         except Exception:
-            title = "NoTitle"
+            print("[bold red]Invalid choice[/bold red]")
+            exit()
+    # confirmation for each manga, then all of them are converted at the same time
+    tasks = []
+    for m in titlelist:
+        print(f"[bold blue]{m}[/bold blue]")
+        with io.open(os.path.join(FOLDER_PATH, m, "infos.json"), "r", encoding="UTF-8") as file:
+            mangaInfos = json.load(file)
+        fileFormat = ("png" if int(mangaInfos["format"]) else "jpg")
+        print(f"Format : {fileFormat}")
+        cfsChoice = int(mangaInfos["fileSys"])
+        journal = Journal(os.path.join(FOLDER_PATH, m, "convert.journal"))
 
-        if fsChoice: # FROM {vol}/{chap}/{page}.* to {vol}/{chap}-{page}.*
-            try:
-                imgPaths = os.listdir(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}"))
-            except FileNotFoundError:
+        if journal.exists(): # interrupted conversion
+            header, moves = journal.read()
+            confirm = input(f"\tAn interrupted conversion was found ({len(moves)} pages planned) : [R]esume or roll [B]ack (R/b) ? ")
+            if confirm == "b":
+                print("[italic]Rolling back...[/italic]")
+                index = ArchiveIndex()
+                apply_moves([(new, old) for (old, new) in reversed(moves)], index)
+                index.close()
+                journal.close()
+                print(f"[bold green]Conversion of {m} rolled back[/bold green]")
                 continue
-            for img in imgPaths: # for each image
-                try:
-                    with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}", f"page-{imgPaths.index(img)+1}.{fileFormat}"), "r+") as ofile:
-                        try:
-                            with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}-p{imgPaths.index(img)+1}.{fileFormat}"), "x+") as file:
-                                file.buffer.write(ofile.buffer.read()) 
-                        except FileExistsError:
-                            pass
-                except FileNotFoundError:
-                    pass
-            try:
-                for img in os.listdir(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}")):
-                    os.remove(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}", img))
-                os.rmdir(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}"))
-            except FileNotFoundError:
-                pass
-        # ==============================================================
-        else: # FROM {vol}/{chap}-{page}.* to {vol}/{chap}/{page}.*
-            try:
-                imgPaths = [img for img in os.listdir(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}")) if img.split('-')[1] == chap]
-            except FileNotFoundError:
+            tasks.append((m, header["from"], header["to"], True))
+        else:
+            print(f"Current file system : [bold green]{Storage.FILE_SYSTEMS[cfsChoice]}[/bold green]")
+            for i, fs in Storage.FILE_SYSTEMS.items():
+                if i != cfsChoice:
+                    print(f"\t- {i} : {fs}")
+            fsChoice = input(f"\tFile system to convert to (empty to cancel) : ")
+            if not fsChoice.isdigit() or int(fsChoice) == cfsChoice or int(fsChoice) not in Storage.FILE_SYSTEMS:
+                print(f"[bold red]Conversion of {m} cancelled[/bold red]")
                 continue
-            for img in imgPaths: # for each image
-                # create folder
-                os.makedirs(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}"), exist_ok=True) 
+            fsChoice = int(fsChoice)
+            journal.start(cfsChoice, fsChoice)
+            tasks.append((m, cfsChoice, fsChoice, False))
+
+    if tasks:
+        print("[italic]Moving images...[/italic]")
+        # create progress bar for mangas
+        prgbar = Progress()
+        prgbar.start()
+        idTask = prgbar.add_task("Conversion", total=len(tasks))
+        with ProcessPoolExecutor(max_workers=min(CONVERT_WORKERS, len(tasks))) as executor:
+            futures = {executor.submit(convert_manga, *task): task[0] for task in tasks}
+            for future in as_completed(futures):
                 try:
-                    with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}-p{imgPaths.index(img)+1}.{fileFormat}"), "r+") as ofile: # or jpg for smaller size
-                        try:
-                            with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}", f"page-{imgPaths.index(img)+1}.{fileFormat}"), "x+") as file: # or jpg for smaller size
-                                file.buffer.write(ofile.buffer.read()) 
-                        except FileExistsError as e:
-                            pass
-                    os.remove(f"{FOLDER_PATH}/{name}/chapters/vol-{vol}/chap-{chap}-{title}-p{imgPaths.index(img)+1}.{fileFormat}")
-                except FileNotFoundError:
-                    pass
-        prgbar.update(idTask, description=f'{name} (vol {vol} chap {chap})', advance=1)
-    prgbar.refresh()
-    prgbar.stop()
-    print("[bold green]Conversion completed ![/bold green]")   
\ No newline at end of file
+                    prgbar.update(idTask, description=f'{futures[future]} ({future.result()} pages moved)', advance=1)
+                except Exception as e:
+                    print(f"[bold red]Conversion of {futures[future]} failed (can be resumed) : {e}")
+                    prgbar.update(idTask, advance=1)
+        prgbar.refresh()
+        prgbar.stop()
+        print("[bold green]Conversion completed ![/bold green]")
@@ -0,0 +1,286 @@
+"""
+Download engine used by Sync.py : a single asyncio event loop running a pipeline of bounded queues
+    - each stage (mangas, chapters, pages) is a queue of jobs serviced by a fixed number of worker tasks
+    - a job submitted to a stage returns a future, so a manga can wait for its chapters and a chapter for its pages
+    - queues are bounded, so a stage that is too fast waits for the next one (the footprint doesn't grow with the library)
+    - each queue is a Scheduler shared by the whole library : jobs have a key (their manga) and a priority, so the new chapters
+      of a manga aren't stuck behind the backfill of another one
+    - the number of jobs running at the same time in a stage can be adapted by an AdaptiveLimit (AIMD) : it grows while
+      the throughput grows without errors, and is halved when errors, 429 or latency climb
+"""
+
+import asyncio # event loop, queues and tasks
+import heapq # jobs of a key, by priority
+from collections import deque
+from itertools import count
+from time import monotonic
+
+_EMPTY = object() # no job waiting (None is the default key)
+
+
+class AdaptiveLimit:
+    """
+    number of jobs of a stage allowed to run at the same time, adapted every window seconds (AIMD) :
+        - + 1 while the throughput (jobs done by second) doesn't drop, with less than errorRate errors
+        - halved if the errors are above errorRate or if the latency is above latencyFactor times the best one seen (0 : not checked),
+          or at once if a handler signals a congestion (429), at most once by window
+    """
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = 64, window: float = 2.0, errorRate: float = 0.05,
+                 latencyFactor: float = 3.0) -> None:
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.errorRate = errorRate
+        self.latencyFactor = latencyFactor
+        self.active = 0
+        self.bestLatency = None
+        self._throughput = 0.0 # jobs by second of the previous window
+        self._reset_window(monotonic())
+        self._decreased = 0.0 # time of the last decrease
+        self._cond = None
+
+    def _reset_window(self, now: float):
+        self._start = now
+        self._done = 0
+        self._errors = 0
+        self._latency = 0.0
+
+    async def acquire(self):
+        """waits until a job can start"""
+        if self._cond is None: # created in the running event loop
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, seconds: float, ok: bool):
+        """called when a job is done (seconds : its duration, None if it wasn't run, ok : if it didn't raise)"""
+        if seconds is not None:
+            self.record(seconds, ok)
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all() # the limit may have grown
+
+    def record(self, seconds: float, ok: bool):
+        if ok:
+            self._done += 1
+            self._latency += seconds
+        else:
+            self._errors += 1
+        now = monotonic()
+        if now - self._start >= self.window and self._done + self._errors:
+            self._adapt(now)
+
+    def error(self):
+        """signal of a handler that a request failed and was retried (5xx, network error...), counted in the errors of the window"""
+        self._errors += 1
+
+    def congestion(self):
+        """signal of a handler that the server is overloaded (429) : the limit is halved at once (once by window)"""
+        self._errors += 1
+        now = monotonic()
+        if now - self._decreased >= self.window:
+            self._decrease(now)
+
+    def _decrease(self, now: float):
+        self.limit = max(self.minimum, self.limit // 2)
+        self._decreased = now
+        self._throughput = 0.0
+        self._reset_window(now)
+
+    def _adapt(self, now: float):
+        throughput = self._done / (now - self._start)
+        errors = self._errors / (self._done + self._errors)
+        latency = self._latency / self._done if self._done else None
+        if latency is not None:
+            self.bestLatency = latency if self.bestLatency is None else min(self.bestLatency, latency)
+        if errors > self.errorRate or (self.latencyFactor and latency is not None and latency > self.latencyFactor * self.bestLatency):
+            if now - self._decreased >= self.window:
+                self._decrease(now)
+                return
+        elif throughput >= 0.95 * self._throughput and self.active >= self.limit - 1: # the limit is used and still pays off
+            self.limit = min(self.maximum, self.limit + 1)
+        self._throughput = throughput
+        self._reset_window(now)
+
+
+class Scheduler:
+    """
+    queue of a stage, shared by the keys of its jobs (the mangas) :
+        - the job with the lowest priority first (ex : new chapters before a backfill), in order for the same key
+        - round robin between the keys of the same priority (the key served the longest time ago first)
+        - a key with perKey jobs running only gets a worker if no other key is waiting (a key alone can use every worker)
+        - at most maxsize jobs waiting by key (put waits, the other keys aren't blocked by a full one)
+    """
+    def __init__(self, maxsize: int = 0, perKey: int = 0) -> None:
+        self.maxsize = maxsize
+        self.perKey = perKey
+        self._jobs: dict[object, list] = {} # key : heap of (priority, order, item)
+        self._running: dict[object, int] = {} # key : jobs taken and not done
+        self._served: dict[object, int] = {} # key : order of its last job taken
+        self._order = count()
+        self._getters = deque() # futures of the workers waiting for a job
+        self._putters: dict[object, deque] = {} # key : futures waiting for room
+
+    @staticmethod
+    def _wake(waiters: deque):
+        """wakes up the first waiter still waiting"""
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def _wait(self, waiters: deque):
+        waiter = asyncio.get_running_loop().create_future()
+        waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled(): # woken up then cancelled : another one is woken up instead
+                self._wake(waiters)
+            raise
+
+    def _next(self):
+        """key of the next job (_EMPTY if there is none)"""
+        best = None
+        for key, jobs in self._jobs.items():
+            if not jobs:
+                continue
+            full = bool(self.perKey) and self._running.get(key, 0) >= self.perKey
+            rank = (full, jobs[0][0], self._served.get(key, -1))
+            if best is None or rank < best[0]:
+                best = (rank, key)
+        return best[1] if best else _EMPTY
+
+    async def put(self, item, key=None, priority: int = 0):
+        """adds a job (waits while its key has maxsize jobs waiting)"""
+        while self.maxsize and len(self._jobs.get(key, ())) >= self.maxsize:
+            await self._wait(self._putters.setdefault(key, deque()))
+        heapq.heappush(self._jobs.setdefault(key, []), (priority, next(self._order), item))
+        self._wake(self._getters)
+
+    async def get(self) -> tuple:
+        """output : (key, item) of the next job (waits if there is none), done(key) must be called once it is finished"""
+        while (key := self._next()) is _EMPTY:
+            await self._wait(self._getters)
+        (_, _, item) = heapq.heappop(self._jobs[key])
+        self._served[key] = next(self._order)
+        self._running[key] = self._running.get(key, 0) + 1
+        if key in self._putters:
+            self._wake(self._putters[key])
+        if self._jobs[key]: # cascade, in case the other waiting workers weren't woken up
+            self._wake(self._getters)
+        return key, item
+
+    def done(self, key):
+        self._running[key] -= 1
+        if not self._running[key] and not self._jobs[key] and not self._putters.get(key): # key forgotten once idle
+            for d in (self._jobs, self._running, self._served, self._putters):
+                d.pop(key, None)
+
+
+class Stage:
+    """queue of jobs (Scheduler) serviced by worker tasks running the same handler (a fixed number of them, or an AdaptiveLimit)"""
+    def __init__(self, name: str, handler, workers: int, maxsize: int = 0, limit: AdaptiveLimit = None, perKey: int = 0) -> None:
+        self.name = name
+        self.handler = handler # async func called with the args of each job
+        self.limit = limit
+        self.workers = limit.maximum if limit else workers
+        self.maxsize = maxsize if maxsize else workers
+        self.perKey = perKey
+        self._queue = None
+        self._tasks = []
+
+    def error(self):
+        """signal of a handler that a request was retried (no effect with a fixed number of workers)"""
+        if self.limit:
+            self.limit.error()
+
+    def congestion(self):
+        """signal of a handler that the server is overloaded (no effect with a fixed number of workers)"""
+        if self.limit:
+            self.limit.congestion()
+
+    def start(self):
+        """creates the queue and the workers (must be called inside the running event loop)"""
+        self._queue = Scheduler(self.maxsize, self.perKey)
+        self._tasks = [asyncio.create_task(self._worker(), name=f"{self.name}-{i}") for i in range(self.workers)]
+        if self.limit:
+            self.limit._cond = None
+            self.limit.active = 0
+
+    async def stop(self):
+        """cancels the workers (jobs still in the queue are dropped)"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, *job, key=None, priority: int = 0) -> asyncio.Future:
+        """
+        adds a job to the queue (waits if the queue is full for this key)
+        param : key : the jobs of a same key (manga) share its place in the queue, see Scheduler
+        param : priority : int : jobs with a lower priority are run first
+        output : asyncio.Future : result (or exception) of the handler for this job
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((job, future), key, priority)
+        return future
+
+    async def _worker(self):
+        while True:
+            if self.limit: # a worker only takes a job it can run, so the scheduler chooses it among every job waiting (priority, key)
+                await self.limit.acquire() # (cancelled only by stop, the limit is reset by start)
+            key, (job, future) = await self._queue.get()
+            start = None
+            ok = False
+            try:
+                if not future.cancelled():
+                    start = monotonic()
+                    result = await self.handler(*job)
+                    ok = True
+                    if not future.cancelled():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.done(key)
+                if self.limit:
+                    await self.limit.release(None if start is None else monotonic() - start, ok)
+
+
+class Engine:
+    """group of stages sharing the same event loop"""
+    def __init__(self) -> None:
+        self.stages: dict[str, Stage] = {}
+
+    def add_stage(self, name: str, handler, workers: int, maxsize: int = 0, limit: AdaptiveLimit = None, perKey: int = 0) -> Stage:
+        """
+        param : limit : AdaptiveLimit : jobs running at the same time (else workers, fixed)
+        param : perKey : int : jobs of a key running at the same time while other keys are waiting (0 : no cap)
+        """
+        self.stages[name] = Stage(name, handler, workers, maxsize, limit, perKey)
+        return self.stages[name]
+
+    def __getitem__(self, name: str) -> Stage:
+        return self.stages[name]
+
+    async def run(self, name: str, jobs: list) -> list:
+        """
+        starts every stage, submits the jobs to the stage called name and waits for all of them
+        output : list : results (or exceptions) of the jobs, in the same order
+        """
+        for stage in self.stages.values():
+            stage.start()
+        try:
+            futures = [await self.stages[name].submit(*job) for job in jobs]
+            return await asyncio.gather(*futures, return_exceptions=True)
+        finally:
+            for stage in self.stages.values():
+                await stage.stop()
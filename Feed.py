@@ -0,0 +1,110 @@
+"""
+Chapters of the feed of a manga, used by Sync.py, Selection.py and Index.py :
+    - Chapter : compact record of a chapter (the attributes used by the scripts, without the rest of the api response)
+    - FeedFile : {manga}/chapters.jsonl, one chapter by line, appended as the pages of the feed arrive
+      (a chapter updated later is appended again, the last line wins), read back with a lazy scan
+the chapters.json of the previous versions is converted at the first read
+"""
+
+import os # IO (replace, remove)
+import io # files
+import json # json handling
+
+
+class Chapter:
+    """chapter of a feed"""
+    __slots__ = ("id", "manga", "volume", "chapter", "title", "language", "group", "publishAt", "updatedAt")
+
+    def __init__(self, id: str, manga: str = "", volume: str = None, chapter: str = None, title: str = None, language: str = "",
+                 group: str = "", publishAt: str = "", updatedAt: str = "") -> None:
+        self.id = id
+        self.manga = manga
+        self.volume = volume
+        self.chapter = chapter
+        self.title = title
+        self.language = language
+        self.group = group
+        self.publishAt = publishAt
+        self.updatedAt = updatedAt
+
+    @classmethod
+    def from_api(cls, c: dict) -> "Chapter":
+        """record of a chapter of an api response (/manga/{id}/feed or /chapter, with includes[]=scanlation_group)"""
+        attributes = c["attributes"]
+        manga = group = ""
+        for r in c.get("relationships", ()):
+            if r["type"] == "manga" and not manga:
+                manga = r["id"]
+            elif r["type"] == "scanlation_group" and not group:
+                group = r.get("attributes", {}).get("name", "")
+        return cls(c["id"], manga, attributes.get("volume"), attributes.get("chapter"), attributes.get("title"),
+                   attributes.get("translatedLanguage") or "", group, attributes.get("publishAt") or "", attributes.get("updatedAt") or "")
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "Chapter":
+        return cls(**d)
+
+    def to_dict(self) -> dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Chapter({self.chapter}, {self.id})"
+
+
+class FeedFile:
+    """chapters.jsonl of a manga"""
+    def __init__(self, folder: str) -> None:
+        self.path = os.path.join(folder, "chapters.jsonl")
+        self.legacy_path = os.path.join(folder, "chapters.json") # full api responses, before the jsonl
+        self.lines = 0 # lines read by the last load (to know if it must be compacted)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self.path) or os.path.isfile(self.legacy_path)
+
+    def _migrate(self):
+        """converts the chapters.json of the previous versions (once)"""
+        if os.path.isfile(self.path) or not os.path.isfile(self.legacy_path):
+            return
+        with io.open(self.legacy_path, "r", encoding="UTF-8") as file:
+            chapters = [Chapter.from_api(c) for c in json.load(file)]
+        self.write(chapters)
+        os.remove(self.legacy_path)
+
+    def append(self, chapters: list):
+        """adds chapters (a page of the feed) at the end of the file"""
+        with io.open(self.path, "a", encoding="UTF-8") as file:
+            file.writelines(json.dumps(c.to_dict()) + "\n" for c in chapters)
+
+    def write(self, chapters: list):
+        """replaces the file with these chapters"""
+        with io.open(f"{self.path}.part", "w", encoding="UTF-8") as file:
+            file.writelines(json.dumps(c.to_dict()) + "\n" for c in chapters)
+        os.replace(f"{self.path}.part", self.path)
+
+    def clear(self):
+        """empties the file (before a whole feed is written again)"""
+        if os.path.isfile(self.legacy_path):
+            os.remove(self.legacy_path)
+        io.open(self.path, "w", encoding="UTF-8").close()
+
+    def scan(self):
+        """lazy scan of the lines (a chapter can be found many times, the last one is the newest)"""
+        self._migrate()
+        if not os.path.isfile(self.path):
+            return
+        self.lines = 0
+        with io.open(self.path, "r", encoding="UTF-8") as file:
+            for line in file:
+                try:
+                    chapter = Chapter.from_dict(json.loads(line))
+                except (json.JSONDecodeError, TypeError): # line cut by an interruption
+                    continue
+                self.lines += 1
+                yield chapter
+
+    def load(self) -> dict[str, Chapter]:
+        """id : last record of each chapter (the file is compacted if more than half of its lines are old records)"""
+        chapters = {c.id: c for c in self.scan()}
+        if self.lines > 2 * len(chapters):
+            self.write(chapters.values())
+        return chapters
@@ -1,11 +1,64 @@
 """
 Global variables used in scripts
 """
+import os # paths
+
 FOLDER_PATH = 'archive' # path of the folder to store the mangas folders with the images (can be either relative to the script folder or absolute)
 LOGIN_PATH = 'login.json'
-SIMULTANEOUS_REQUESTS = 10 # should always be under 40 (10 is best)
+TOKEN_REFRESH_MARGIN = 60 # seconds before its expiry the session token is refreshed during a sync (valid 15 min)
+INDEX_PATH = os.path.join(FOLDER_PATH, 'index.db') # SQLite index of the archive (pages already saved, chapters done...)
+LANGUAGES = ["en"] # translated languages of the chapters to get, by order of preference when a chapter has many (ex : ["fr", "en"])
+PREFERRED_GROUPS = [] # scanlation groups chosen first when a chapter has many releases, in order (then the newest release)
+SIMULTANEOUS_MANGAS = 4 # number of manga feeds gathered at the same time
+SIMULTANEOUS_REQUESTS = 10 # number of chapters in progress at the same time, for all mangas (api requests are paced by the rate limiter)
+SIMULTANEOUS_PAGES = 20 # number of pages downloaded at the same time, for all chapters
+ADAPTIVE_CONCURRENCY = True # the two values above are only the start, then adapted to the throughput and errors (AIMD)
+SIMULTANEOUS_CHAPTERS_BY_MANGA = 4 # chapters of one manga in progress at the same time while other mangas are waiting (a manga alone uses every worker)
+BACKFILL_CHAPTERS = 20 # a manga with more new chapters is a backfill : its chapters and pages go after the new releases of the other mangas
+MAX_SIMULTANEOUS_REQUESTS = 40 # max chapters in progress at the same time with ADAPTIVE_CONCURRENCY
+MAX_SIMULTANEOUS_PAGES = 100 # max pages downloaded at the same time with ADAPTIVE_CONCURRENCY
+QUEUE_SIZE = 100 # max number of pages waiting for a download worker
+CHUNK_SIZE = 64 * 1024 # bytes read at a time from the network or a file
+WRITE_WORKERS = 4 # threads saving the downloaded pages (renamed, or added to their cbz)
+WRITE_QUEUE_SIZE = 32 # max downloaded pages waiting for a writer (the downloads wait when it is full)
+WRITE_BUFFER = 256 * 1024 # bytes of a page being downloaded written at a time to its temporary file (in a thread)
+FSYNC_BATCH = 0 # flush the data to the disk every FSYNC_BATCH pages written (0 : left to the os)
+VERIFY_WORKERS = 0 # processes used to check the hashes of the pages (0 : one by core)
+CONVERT_WORKERS = 4 # processes used by Converter.py (one manga by process)
+MAX_CONNECTIONS = 20 # max connections kept open to each host (api and M@H nodes)
+REQUEST_TIMEOUT = 60.0 # seconds before a request is considered as failed
+API_RATE_LIMIT = 5 # requests per second on api.mangadex.org (global limit by IP)
+AT_HOME_RATE_LIMIT = 40 # requests per minute on /at-home/server
+RATE_LIMIT_RETRIES = 5 # times a request is sent again after a 429
+REQUEST_RETRIES = 4 # times an api request is sent again after a network error or a 5xx
+PAGE_RETRIES = 4 # times a page is requested again after a network error or a 5xx
+RETRY_BACKOFF = 0.5 # seconds before the first retry (doubled at each retry, with jitter)
+MAX_BACKOFF = 30.0 # max seconds between two retries
+AT_HOME_TTL = 10 * 60 # seconds a M@H server given for a chapter is used (valid for 15 min)
+AT_HOME_RETRIES = 2 # times a new M@H server is asked for the pages that failed on the previous one
+NODE_MAX_ERRORS = 3 # errors in a row after which a M@H node is avoided (another one is asked, or uploads.mangadex.org)
+NODE_SLOW_SECONDS = 10.0 # average seconds by page after which a M@H node is avoided
+NODE_COOLDOWN = 60.0 # seconds a degraded M@H node is avoided
+AT_HOME_REPORT = True # report the result of each page to M@H (expected by the network to rate its nodes)
+DISCOVERY_BATCH = 100 # mangas asked at once for their new chapters in update mode
+METRICS_PATH = os.path.join(FOLDER_PATH, 'metrics.json') # report of the last run (requests, latencies, pages/s...)
+PROMETHEUS_PATH = '' # Prometheus text file also written at the end of each run if set (ex : for the textfile collector of node_exporter)
+WATCH_INTERVAL = 60 * 60 # seconds between two updates of the library in watch mode (Sync.py --watch)
+SEARCH_TTL = 10 * 60 # seconds a page of search or follows results is kept in FOLDER_PATH/.cache
+TAGS_TTL = 7 * 24 * 3600 # seconds the list of the tags of MangaDex is kept in FOLDER_PATH/.cache
 __VERSION__ = '1.3'
 __AUTHOR__ = 'Merlet Raphaël'
 def format_title(title: str) -> str:
     """format titles to be usable as filenames and foldernames"""
-    return "".join(list(filter(lambda x: x not in (".", ":", '"', "?", "/", '<', '>'), title)))
\ No newline at end of file
+    return "".join(list(filter(lambda x: x not in (".", ":", '"', "?", "/", '<', '>'), title)))
+
+def page_path(name, vol, chap, title, page, fileFormat, fsChoice, folder: str = FOLDER_PATH) -> str:
+    """path of a page of a chapter, depending on the file system of the manga (folder : archive of the library)"""
+    if fsChoice == 2:
+        # CBZ FILE SYSTEM ({vol}/{chap}.cbz, the page is a file in the cbz)
+        return os.path.join(folder, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}.cbz", f"page-{page}.{fileFormat}")
+    if fsChoice:
+        # NORMAL FILE SYSTEM ({vol}/{chap}-{page}.*)
+        return os.path.join(folder, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}-p{page}.{fileFormat}")
+    # OTHER FILE SYSTEM ({vol}/{chap}/{page}.*)
+    return os.path.join(folder, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}", f"page-{page}.{fileFormat}")
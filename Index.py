@@ -0,0 +1,134 @@
+"""
+SQLite index of the archive (stored in FOLDER_PATH/index.db), used by Sync.py and Converter.py :
+    - mangas : id, name and settings of each manga (same as infos.json)
+    - chapters : every chapter of the feed of a manga, with its status (new, incomplete, done)
+    - pages : every page saved, with its filename on M@H (contains the hash of the page), size, path and status (done, missing, corrupt)
+      and the mtime of the file when its hash was last checked
+it is used to know which pages are already there without walking the folders of the archive
+"""
+
+import os # IO (makedirs)
+import sqlite3 # on-disk index
+from Globals import INDEX_PATH
+from Selection import chapter_order
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mangas (
+    id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    fileSys INTEGER,
+    format INTEGER,
+    lastSync TEXT
+);
+CREATE INDEX IF NOT EXISTS mangas_name ON mangas (name);
+CREATE TABLE IF NOT EXISTS chapters (
+    id TEXT PRIMARY KEY,
+    manga TEXT NOT NULL,
+    volume TEXT,
+    chapter TEXT,
+    title TEXT,
+    pages INTEGER,
+    status TEXT NOT NULL DEFAULT 'new'
+);
+CREATE INDEX IF NOT EXISTS chapters_manga ON chapters (manga);
+CREATE TABLE IF NOT EXISTS pages (
+    chapter TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    filename TEXT,
+    size INTEGER,
+    path TEXT,
+    status TEXT NOT NULL DEFAULT 'done',
+    mtime REAL,
+    PRIMARY KEY (chapter, page)
+);
+CREATE INDEX IF NOT EXISTS pages_path ON pages (path);
+"""
+# columns added after the first version of the index : (table, column, type)
+MIGRATIONS = [
+    ("pages", "mtime", "REAL"),
+]
+
+
+class ArchiveIndex:
+    """connection to the index of the archive (writes are committed by chapter, or by commit/close)"""
+    def __init__(self, path: str = INDEX_PATH) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30.0) # waits for the other processes writing (Converter.py)
+        self.db.execute("PRAGMA journal_mode=WAL") # readers (Converter.py) don't block the sync
+        self.db.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        for (table, column, type) in MIGRATIONS:
+            if column not in [row[1] for row in self.db.execute(f"PRAGMA table_info({table})")]:
+                self.db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {type}")
+        self.db.commit()
+
+    # MANGAS ==========================
+    def add_manga(self, idManga: str, name: str, fileSys: int, format: int, lastSync: str = ""):
+        self.db.execute("INSERT INTO mangas VALUES (?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET "
+                        "name=excluded.name, fileSys=excluded.fileSys, format=excluded.format, lastSync=excluded.lastSync",
+                        (idManga, name, fileSys, format, lastSync))
+        self.db.commit()
+
+    def manga_id(self, name: str) -> str:
+        """id of the manga stored in the folder name ('' if it isn't indexed)"""
+        row = self.db.execute("SELECT id FROM mangas WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else ""
+
+    # CHAPTERS ========================
+    def add_chapters(self, idManga: str, chapters: list, present: list = ()):
+        """
+        adds the chapters of a feed (Feed.Chapter records, already indexed chapters are kept as they are)
+        param : present : chapter numbers already in the archive before it was indexed (added as done)
+        """
+        present = set(present)
+        self.db.executemany("INSERT OR IGNORE INTO chapters (id, manga, volume, chapter, title, status) VALUES (?, ?, ?, ?, ?, ?)",
+                            [(c.id, idManga, c.volume, c.chapter, c.title, 'done' if str(c.chapter) in present else 'new') for c in chapters])
+        self.db.commit()
+
+    def chapter_done(self, idChapter: str, pages: int, complete: bool = True):
+        self.db.execute("UPDATE chapters SET pages = ?, status = ? WHERE id = ?",
+                        (pages, 'done' if complete else 'incomplete', idChapter))
+        self.db.commit()
+
+    def chapter_list(self, idManga: str) -> list[str]:
+        """numbers of the chapters of the manga that are done, sorted"""
+        chapters = [row[0] for row in self.db.execute("SELECT DISTINCT chapter FROM chapters WHERE manga = ? AND status = 'done'", (idManga,))]
+        chapters.sort(key=chapter_order)
+        return chapters
+
+    # PAGES ===========================
+    def add_page(self, idChapter: str, page: int, filename: str, path: str, size: int, mtime: float = None):
+        """param : mtime : mtime of the file if its hash was checked (while it was downloaded)"""
+        self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, 'done', ?)", (idChapter, page, filename, size, path, mtime))
+
+    def pages_done(self, idChapter: str) -> set[int]:
+        """numbers of the pages of the chapter that are saved"""
+        return {row[0] for row in self.db.execute("SELECT page FROM pages WHERE chapter = ? AND status = 'done'", (idChapter,))}
+
+    def pages_to_verify(self, idMangas: list) -> list[tuple]:
+        """(chapter, page, filename, path, size, mtime) of the pages saved for the mangas"""
+        marks = ", ".join("?" * len(idMangas))
+        return self.db.execute("SELECT p.chapter, p.page, p.filename, p.path, p.size, p.mtime FROM pages p JOIN chapters c ON p.chapter = c.id "
+                               f"WHERE c.manga IN ({marks}) AND p.status = 'done'", list(idMangas)).fetchall()
+
+    def page_verified(self, idChapter: str, page: int, size: int, mtime: float):
+        self.db.execute("UPDATE pages SET size = ?, mtime = ? WHERE chapter = ? AND page = ?", (size, mtime, idChapter, page))
+
+    def page_status(self, idChapter: str, page: int, status: str):
+        """marks a page as missing or corrupt (its chapter becomes incomplete, so it is downloaded again)"""
+        self.db.execute("UPDATE pages SET status = ? WHERE chapter = ? AND page = ?", (status, idChapter, page))
+        self.db.execute("UPDATE chapters SET status = 'incomplete' WHERE id = ?", (idChapter,))
+
+    def move_page(self, oldPath: str, newPath: str):
+        """updates the path of a page moved by Converter.py"""
+        self.db.execute("UPDATE pages SET path = ? WHERE path = ?", (newPath, oldPath))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,151 @@
+"""
+Library API of the sync, to call it from another python process without the console (ex : a worker of an orchestrator) :
+    - sync_manga(id, layout, quality) : syncs a new manga (or updates it if it is already in the archive)
+    - update_library(path) : updates the mangas of the archive (new chapters found in a few requests)
+    - verify_library(path) : checks the pages and infos.json of the mangas of the archive
+    - close() : closes the session (also called at exit)
+the session (clients, token, index, metrics) is opened at the first call and kept for the next ones on its own event loop,
+and Sync.py (httpx, rich...) is only imported then, so importing this module costs nothing
+every call runs in one dedicated thread, which owns the session (the sqlite index and the event loop can't change of thread) :
+the functions can be called from any thread, the calls are run one at a time in their order
+path is the folder of the archive and login.json (like --library of Sync.py, the working directory if None), the session is
+opened again if it changes (its paths are derived from it, see Sync.set_library : the working directory is never changed)
+ex :
+    import Library
+    Library.sync_manga("a96676e5-8ae2-425e-b549-7f15dd34a6d8", layout=2, quality=0, path="/data/mangas")
+    Library.update_library("/data/mangas")
+"""
+
+import os # IO
+import json # infos.json of the mangas
+import atexit # session closed at exit
+import asyncio # event loop of the session
+import queue # calls waiting for the thread of the session
+import threading # thread of the session
+from concurrent.futures import Future # result of a call
+
+_loop: asyncio.AbstractEventLoop = None # event loop of the session (its clients are bound to it)
+_path: str = None # library of the session
+_thread: threading.Thread = None # thread of the session, started at the first call
+_calls = queue.Queue() # (func, args, future) waiting for the thread
+_lock = threading.Lock()
+
+
+def _worker():
+    while True:
+        (func, args, future) = _calls.get()
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+
+def _call(func, *args):
+    """runs func in the thread of the session and waits for its result"""
+    global _thread
+    with _lock:
+        if _thread is None: # (daemon : still running when the session is closed at exit)
+            _thread = threading.Thread(target=_worker, name="mangadex-sync", daemon=True)
+            _thread.start()
+    if threading.current_thread() is _thread:
+        return func(*args)
+    future = Future()
+    _calls.put((func, args, future))
+    return future.result()
+
+def _session(path: str = None):
+    """opens the session of the library in path if it isn't already, output : Sync module"""
+    global _loop, _path
+    import Sync # (heavy imports : only at the first call)
+    path = os.path.abspath(path if path else os.getcwd())
+    if _loop is not None and path != _path:
+        _close()
+    if _loop is None:
+        Sync.set_library(path) # FOLDER_PATH, LOGIN_PATH and the index in path
+        _loop = asyncio.new_event_loop()
+        Sync.open_session(False)
+        _path = path
+    return Sync
+
+def _run(Sync, coro):
+    """runs a coroutine of Sync in the event loop of the session (the index is committed after it)"""
+    try:
+        return _loop.run_until_complete(coro)
+    finally:
+        Sync.index.commit()
+
+def _failures(mList: list, results: list) -> dict:
+    return {m if isinstance(m, str) else m["id"]: result for m, result in zip(mList, results) if isinstance(result, Exception)}
+
+def sync_manga(id: str, layout: int = 1, quality: int = 1, path: str = None):
+    """
+    syncs a manga (new chapters only if it is already in the archive, with its own layout and quality)
+    param : id : str : id of the manga, or link to its page
+    param : layout : int : file system of a new manga (see Storage.FILE_SYSTEMS)
+    param : quality : int : 0 : jpg (compressed), 1 : png (original)
+    raises the error of the sync if it failed
+    """
+    return _call(_sync_manga, id, layout, quality, path)
+
+def _sync_manga(id: str, layout: int, quality: int, path: str):
+    Sync = _session(path)
+    idManga = id.split('/')[-2] if len(id) > 36 else id
+    folder = None
+    for f in Sync.library():
+        with open(os.path.join(Sync.FOLDER_PATH, f, "infos.json"), "r", encoding="UTF-8") as file:
+            if json.load(file).get("id") == idManga:
+                folder = f
+                break
+    if folder:
+        mList = [folder]
+    else:
+        mList = Sync.get_mangas_by_id([idManga])
+        if not mList:
+            raise ValueError(f"manga not found : {id}")
+    results = _run(Sync, Sync.sync_mangas(mList, layout, quality, update=folder is not None))
+    for error in _failures(mList, results).values():
+        raise error
+
+def update_library(path: str = None, titles: list = None) -> dict:
+    """
+    updates the mangas of the archive
+    param : titles : list : folders of the mangas to update (all if None)
+    output : dict : manga : error, for the mangas that failed
+    """
+    return _call(_update_library, path, titles)
+
+def _update_library(path: str, titles: list) -> dict:
+    Sync = _session(path)
+    mList = titles if titles is not None else Sync.library()
+    return _failures(mList, _run(Sync, Sync.sync_mangas(mList, update=True)))
+
+def verify_library(path: str = None, titles: list = None) -> int:
+    """
+    checks the pages and infos.json of the mangas of the archive (see Sync.verify_library)
+    param : titles : list : folders of the mangas to check (all if None)
+    output : int : number of changes made to infos.json files
+    """
+    return _call(_verify_library, path, titles)
+
+def _verify_library(path: str, titles: list) -> int:
+    Sync = _session(path)
+    try:
+        return Sync.verify_library(titles if titles is not None else Sync.library())
+    finally:
+        Sync.index.commit()
+
+def close():
+    """closes the clients and the index of the session"""
+    if _loop is not None:
+        _call(_close)
+
+def _close():
+    global _loop, _path
+    import Sync
+    try:
+        _loop.run_until_complete(Sync.close_session())
+    finally:
+        _loop.close()
+        _loop = None
+        _path = None
+
+atexit.register(close)
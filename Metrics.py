@@ -0,0 +1,150 @@
+"""
+Metrics of a sync, used by Sync.py and Network.py :
+    - counters (requests, 429, retries, pages, bytes...), gauges (concurrency limits...) and histograms (latency of the requests by endpoint, downloads, disk writes...)
+    - exported at the end of a run as json (FOLDER_PATH/metrics.json) and, if asked, as a Prometheus text file
+      (for the textfile collector of node_exporter), the values are kept between the cycles of the watch mode
+"""
+
+import os # IO (replace)
+import json # json export
+from bisect import bisect_left # bucket of an observation
+from contextlib import contextmanager # timers
+from time import perf_counter, time
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+PREFIX = "mangadex_sync_"
+
+
+class Histogram:
+    """distribution of observations (cumulative buckets, like Prometheus)"""
+    def __init__(self, buckets: tuple = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """upper bound of the bucket of the quantile q (max if it is in +Inf)"""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def report(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": round(self.quantile(0.5), 6),
+            "p95": round(self.quantile(0.95), 6),
+            "max": round(self.max, 6),
+        }
+
+
+class Metrics:
+    """counters and histograms by name and labels (ex : inc('requests_total', endpoint='/chapter', status=200))"""
+    def __init__(self) -> None:
+        self.started = time()
+        self.counters: dict[tuple, float] = {} # (name, labels) : value
+        self.gauges: dict[tuple, float] = {} # (name, labels) : last value
+        self.histograms: dict[tuple, Histogram] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = self._key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        if key not in self.histograms:
+            self.histograms[key] = Histogram()
+        self.histograms[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """observes the seconds spent in the block (even if it raised)"""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start, **labels)
+
+    def value(self, name: str, **labels) -> float:
+        """sum of the counter name for every label matching labels"""
+        wanted = set((k, str(v)) for k, v in labels.items())
+        return sum(v for (n, l), v in self.counters.items() if n == name and wanted <= set(l))
+
+    # EXPORT ==========================
+    def report(self) -> dict:
+        """every metric, with the rates of the run (pages/s, MB/s)"""
+        seconds = time() - self.started
+        def label(name, labels):
+            return name + ("{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else "")
+        return {
+            "started": self.started,
+            "seconds": round(seconds, 3),
+            "pages_per_s": round(self.value("pages_total") / seconds, 3) if seconds else 0.0,
+            "mb_per_s": round(self.value("page_bytes_total") / 1024**2 / seconds, 3) if seconds else 0.0,
+            "counters": {label(n, l): v for (n, l), v in sorted(self.counters.items())},
+            "gauges": {label(n, l): v for (n, l), v in sorted(self.gauges.items())},
+            "histograms": {label(n, l): h.report() for (n, l), h in sorted(self.histograms.items())},
+        }
+
+    def prometheus(self) -> str:
+        """metrics in the Prometheus text format"""
+        lines = []
+        def labels(items, extra=()):
+            items = list(items) + list(extra)
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}" if items else ""
+        for name in sorted(set(n for n, _ in self.counters)):
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+            for (n, l), v in sorted(self.counters.items()):
+                if n == name:
+                    lines.append(f"{PREFIX}{n}{labels(l)} {v}")
+        for name in sorted(set(n for n, _ in self.gauges)):
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            for (n, l), v in sorted(self.gauges.items()):
+                if n == name:
+                    lines.append(f"{PREFIX}{n}{labels(l)} {v}")
+        for name in sorted(set(n for n, _ in self.histograms)):
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            for (n, l), h in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{n}_bucket{labels(l, [('le', bound)])} {cumulative}")
+                lines.append(f"{PREFIX}{n}_sum{labels(l)} {h.sum}")
+                lines.append(f"{PREFIX}{n}_count{labels(l)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _write(path: str, text: str):
+        """written in a temporary file then renamed, so a reader never gets half a file"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.part", "w", encoding="UTF-8") as file:
+            file.write(text)
+        os.replace(f"{path}.part", path)
+
+    def write_json(self, path: str):
+        self._write(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus(self, path: str):
+        self._write(path, self.prometheus())
@@ -0,0 +1,376 @@
+"""
+Network helpers used by Sync.py :
+    - ClientPool : one keep-alive httpx.AsyncClient per host (api.mangadex.org, each M@H node...), reused for the whole run
+    - RateLimiter : token buckets shared by every worker for the MangaDex API limits, fed by the X-RateLimit headers
+    - backoff / is_retryable : retry policy of failed requests
+    - AtHomeCache : M@H server of each chapter, resolved ahead of time and kept for its validity window
+    - NodeHealth : latency and errors of each M@H node over the run (degraded nodes are avoided), and the /report of each page expected by M@H
+every request is measured in the Metrics of the pool (latency by endpoint, status, 429 and time waited for the rate limits)
+"""
+
+import asyncio # sleep and locks of the buckets
+import importlib.util # check if the http2 extra of httpx is installed
+import random # jitter of the backoff
+import re # ids in the urls (metrics by endpoint)
+from contextlib import asynccontextmanager # streamed responses
+from time import monotonic, perf_counter, time # time is time since Epoch (used by X-RateLimit-Retry-After)
+import httpx # async requests
+from Metrics import Metrics
+from Globals import MAX_CONNECTIONS, REQUEST_TIMEOUT, API_RATE_LIMIT, AT_HOME_RATE_LIMIT, RATE_LIMIT_RETRIES, RETRY_BACKOFF, MAX_BACKOFF, AT_HOME_TTL, REQUEST_RETRIES, \
+    NODE_MAX_ERRORS, NODE_SLOW_SECONDS, NODE_COOLDOWN, AT_HOME_REPORT
+
+HTTP2 = importlib.util.find_spec("h2") is not None # pip install httpx[http2]
+
+API_HOST = "api.mangadex.org"
+AT_HOME_URL = f"https://{API_HOST}/at-home/server"
+UPLOADS_URL = "https://uploads.mangadex.org" # main server of the pages (fallback when the M@H nodes are degraded, never reported)
+REPORT_URL = "https://api.mangadex.network/report"
+ID_PATTERN = re.compile(r"[^/]*\d[^/]*") # segments of a path with a digit are ids (uuid, hash...)
+
+
+def endpoint(url: httpx.URL) -> str:
+    """name of the endpoint of a url, without its ids (ex : /manga/{id}/feed, the pages of every M@H node are 'at-home node')"""
+    if url.host == "api.mangadex.network":
+        return "/report"
+    if url.host != API_HOST:
+        return "at-home node"
+    return ID_PATTERN.sub("{id}", url.path)
+
+def backoff(attempt: int, base: float = RETRY_BACKOFF, cap: float = MAX_BACKOFF) -> float:
+    """seconds to wait before the retry number attempt (exponential, with full jitter so workers don't retry all at once)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+def retry_after(rep: httpx.Response) -> float:
+    """seconds to wait given by a response (X-RateLimit-Retry-After of MangaDex, else Retry-After), None if it gives none"""
+    try:
+        if 'X-RateLimit-Retry-After' in rep.headers: # timestamp (since Epoch) of the end of the limit
+            return max(float(rep.headers['X-RateLimit-Retry-After']) - time(), 0.0)
+        if 'Retry-After' in rep.headers: # seconds
+            return max(float(rep.headers['Retry-After']), 0.0)
+    except ValueError: # (Retry-After can also be a date)
+        pass
+    return None
+
+def is_retryable(e: Exception) -> bool:
+    """if a failed request is worth sending again (network errors, 429 and 5xx)"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+
+class TokenBucket:
+    """
+    token bucket of rate requests every per seconds, waiting workers are served in order
+    the bucket can be emptied or blocked by the server (X-RateLimit-Remaining, Retry-After)
+    """
+    def __init__(self, rate: int, per: float = 1.0) -> None:
+        self.capacity = rate
+        self.fill_rate = rate / per # tokens by second
+        self._tokens = float(rate)
+        self._updated = monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.fill_rate)
+        self._updated = now
+
+    async def acquire(self):
+        """waits until a request can be sent"""
+        async with self._lock: # only the first waiting worker sleeps on the bucket, the others wait for their turn
+            while True:
+                self._refill()
+                if self._blocked_until > self._updated:
+                    await asyncio.sleep(self._blocked_until - self._updated)
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    await asyncio.sleep((1 - self._tokens) / self.fill_rate)
+
+    def update(self, rep: httpx.Response):
+        """updates the bucket with the rate limit headers of a response of its endpoint"""
+        self._refill()
+        remaining = rep.headers.get('X-RateLimit-Remaining')
+        if remaining is not None and remaining.isdigit():
+            self._tokens = min(self._tokens, float(remaining))
+        if rep.status_code == 429 or remaining == '0':
+            wait = retry_after(rep)
+            if wait is None:
+                wait = 1 / self.fill_rate
+            self._tokens = 0.0
+            self._blocked_until = max(self._blocked_until, monotonic() + wait)
+
+
+class RateLimiter:
+    """buckets of the MangaDex API : a global one for the whole api and one for /at-home/server (on top of the global one)"""
+    def __init__(self, api_rate: int = API_RATE_LIMIT, at_home_rate: int = AT_HOME_RATE_LIMIT) -> None:
+        self.api = TokenBucket(api_rate, 1.0)
+        self.at_home = TokenBucket(at_home_rate, 60.0)
+
+    def buckets(self, url: httpx.URL) -> list[TokenBucket]:
+        """buckets used by a request, from the most global to the most specific (M@H nodes aren't limited)"""
+        if url.host != API_HOST:
+            return []
+        if url.path.startswith('/at-home/server'):
+            return [self.api, self.at_home]
+        return [self.api]
+
+    async def acquire(self, url: httpx.URL):
+        for bucket in self.buckets(url):
+            await bucket.acquire()
+
+    def update(self, url: httpx.URL, rep: httpx.Response):
+        buckets = self.buckets(url)
+        if buckets:
+            buckets[-1].update(rep)
+
+
+class ClientPool:
+    """
+    keeps one client by host, so consecutive chapters on the same node reuse the same connections
+    (no new DNS + TCP + TLS handshake per chapter), with HTTP/2 multiplexing when available
+    every request to the api goes through the rate limiter, and is sent again (after waiting) if it got a 429
+    """
+    def __init__(self, max_connections: int = MAX_CONNECTIONS, timeout: float = REQUEST_TIMEOUT, http2: bool = HTTP2, 
+                 limiter: RateLimiter = None, transport: httpx.AsyncBaseTransport = None, metrics: Metrics = None) -> None:
+        self.limiter = limiter if limiter else RateLimiter()
+        self.metrics = metrics if metrics else Metrics()
+        self.transport = transport # used instead of the network if given (Benchmark.py)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(timeout, connect=10.0)
+        self.http2 = http2
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._headers: dict[str, dict] = {} # host : headers sent with each of its requests
+
+    @staticmethod
+    def host(url: str) -> str:
+        url = httpx.URL(url)
+        return f"{url.scheme}://{url.netloc.decode('ascii')}"
+
+    def client(self, url: str) -> httpx.AsyncClient:
+        """client for the host of url (created at first use)"""
+        host = self.host(url)
+        if host not in self._clients:
+            self._clients[host] = httpx.AsyncClient(http2=self.http2, limits=self.limits, timeout=self.timeout, transport=self.transport,
+                                                    headers=self._headers.get(host))
+        return self._clients[host]
+
+    def set_headers(self, url: str, headers: dict):
+        """headers sent with every request to the host of url, instead of the ones set before (ex : bearer of the api, updated when it is refreshed)"""
+        host = self.host(url)
+        old = self._headers.get(host, {})
+        self._headers[host] = dict(headers)
+        if host in self._clients:
+            for name in old:
+                self._clients[host].headers.pop(name, None)
+            self._clients[host].headers.update(headers)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        sends the request with the client of its host, paced by the rate limiter
+        network errors and 5xx are sent again REQUEST_RETRIES times with a jittered exponential backoff
+        output : httpx.Response : last response (still a 429 if the limit was hit RATE_LIMIT_RETRIES times, or a 5xx)
+        """
+        client = self.client(url)
+        key = httpx.URL(url)
+        name = endpoint(key)
+        rateLimited = errors = 0
+        while True:
+            await self._acquire(key, name)
+            start = perf_counter()
+            try:
+                rep = await client.request(method, url, **kwargs)
+                self._measure(key, name, rep, perf_counter() - start)
+                if rep.status_code == 429:
+                    rateLimited += 1
+                    if rateLimited < RATE_LIMIT_RETRIES:
+                        continue # (the limiter waits for the end of the limit)
+                if rep.status_code < 500:
+                    return rep
+                rep.raise_for_status() # 5xx : sent again below
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                if isinstance(e, httpx.TransportError):
+                    self.metrics.inc("request_errors_total", endpoint=name, error=type(e).__name__)
+                if errors == REQUEST_RETRIES or not is_retryable(e):
+                    if isinstance(e, httpx.HTTPStatusError):
+                        return e.response # (raised by the caller)
+                    raise
+                self.metrics.inc("request_retries_total", endpoint=name)
+                await asyncio.sleep(backoff(errors))
+                errors += 1
+
+    async def _acquire(self, key: httpx.URL, name: str):
+        """waits for the rate limiter (the time waited is measured)"""
+        start = perf_counter()
+        await self.limiter.acquire(key)
+        self.metrics.observe("rate_limit_wait_seconds", perf_counter() - start, endpoint=name)
+
+    def _measure(self, key: httpx.URL, name: str, rep: httpx.Response, seconds: float):
+        """updates the rate limiter and the metrics with a response (seconds : until its headers)"""
+        self.limiter.update(key, rep)
+        self.metrics.observe("request_seconds", seconds, endpoint=name)
+        self.metrics.inc("requests_total", endpoint=name, status=rep.status_code)
+        if rep.status_code == 429:
+            self.metrics.inc("rate_limited_total", endpoint=name)
+            wait = retry_after(rep)
+            if wait is not None:
+                self.metrics.inc("retry_after_seconds_total", wait, endpoint=name)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """same as request, but the body is read by the caller chunk by chunk (no retry on 429)"""
+        client = self.client(url)
+        key = httpx.URL(url)
+        name = endpoint(key)
+        await self._acquire(key, name)
+        start = perf_counter()
+        try:
+            async with client.stream(method, url, **kwargs) as rep:
+                self._measure(key, name, rep, perf_counter() - start)
+                yield rep
+        except httpx.TransportError as e:
+            self.metrics.inc("request_errors_total", endpoint=name, error=type(e).__name__)
+            raise
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def aclose(self):
+        """closes every client (must be called in the event loop that used them)"""
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+
+class AtHomeCache:
+    """
+    /at-home/server responses of the chapters, kept AT_HOME_TTL seconds from their arrival (the adresses given by M@H expire after 15 min)
+    a chapter can be resolved in the background (prefetch) before it starts, so its pages can be requested right away
+    """
+    def __init__(self, pool: ClientPool, ttl: float = AT_HOME_TTL) -> None:
+        self.pool = pool
+        self.ttl = ttl
+        self._entries: dict[str, tuple[float, asyncio.Task]] = {} # idChapter : (expiration, task of the request)
+
+    async def _resolve(self, idChapter: str) -> dict:
+        rep = await self.pool.get(f"{AT_HOME_URL}/{idChapter}", params={'forcePort443': True})
+        rep.raise_for_status()
+        task = asyncio.current_task()
+        if self._entries.get(idChapter, (0, None))[1] is task: # expires from now (not from the wait in the rate limiter)
+            self._entries[idChapter] = (monotonic() + self.ttl, task)
+        return rep.json()
+
+    def _prune(self):
+        """drops the expired entries (prefetched chapters never synced, in a session kept by the watch mode)"""
+        now = monotonic()
+        for idChapter in [i for i, (expiration, task) in self._entries.items() if expiration < now and task.done()]:
+            del self._entries[idChapter]
+
+    def _start(self, idChapter: str) -> asyncio.Task:
+        self._prune()
+        task = asyncio.create_task(self._resolve(idChapter))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception()) # a failed prefetch is raised by get, not logged by asyncio
+        self._entries[idChapter] = (float("inf"), task) # (expiration set once resolved)
+        return task
+
+    def prefetch(self, idChapter: str):
+        """starts the request for the chapter if it isn't already cached"""
+        if idChapter not in self._entries or self._entries[idChapter][0] < monotonic():
+            self._start(idChapter)
+
+    async def get(self, idChapter: str, refresh: bool = False) -> dict:
+        """
+        json of /at-home/server for the chapter (from the cache, or requested now)
+        param : refresh : bool : ignores the cache (when the server given before is failing)
+        """
+        entry = self._entries.get(idChapter)
+        if refresh or entry is None or entry[0] < monotonic():
+            task = self._start(idChapter)
+        else:
+            task = entry[1]
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if self._entries.get(idChapter, (0, None))[1] is task: # failed requests aren't cached
+                del self._entries[idChapter]
+            raise
+
+    def done(self, idChapter: str):
+        """drops the entry of a chapter once its pages are done"""
+        self._entries.pop(idChapter, None)
+
+    def clear(self):
+        """cancels the requests still running and empties the cache"""
+        for _, task in self._entries.values():
+            task.cancel()
+        self._entries = {}
+
+
+class Node:
+    """health of a M@H node"""
+    __slots__ = ("latency", "pages", "errors", "until")
+
+    def __init__(self) -> None:
+        self.latency = 0.0 # seconds by page (exponential moving average)
+        self.pages = 0 # pages downloaded
+        self.errors = 0 # errors in a row
+        self.until = 0.0 # monotonic time until which the node is avoided
+
+
+class NodeHealth:
+    """
+    latency and errors of the M@H nodes over the run, and the report of each page that M@H expects
+    a node is degraded after NODE_MAX_ERRORS errors in a row or if its pages take more than NODE_SLOW_SECONDS on average,
+    it is avoided for NODE_COOLDOWN seconds, then given another chance
+    """
+    def __init__(self, pool: ClientPool, report: bool = AT_HOME_REPORT) -> None:
+        self.pool = pool
+        self.report = report
+        self._nodes: dict[str, Node] = {} # host : health
+        self._reports: set[asyncio.Task] = set() # reports being sent
+
+    def degraded(self, url: str) -> bool:
+        node = self._nodes.get(ClientPool.host(url))
+        return node is not None and node.until > monotonic()
+
+    def record(self, url: str, success: bool, size: int, seconds: float, cached: bool = False):
+        """result of the download of a page (size : bytes received), reported to M@H"""
+        host = ClientPool.host(url)
+        node = self._nodes.setdefault(host, Node())
+        wasDegraded = node.until > monotonic()
+        if success:
+            node.errors = 0
+            node.pages += 1
+            node.latency = seconds if node.pages == 1 else 0.8 * node.latency + 0.2 * seconds
+            if node.pages >= 5 and node.latency > NODE_SLOW_SECONDS:
+                node.until = monotonic() + NODE_COOLDOWN
+        else:
+            node.errors += 1
+            if node.errors >= NODE_MAX_ERRORS:
+                node.until = monotonic() + NODE_COOLDOWN
+        if node.until > monotonic() and not wasDegraded:
+            self.pool.metrics.inc("node_degraded_total")
+        if self.report and host != UPLOADS_URL:
+            self._send(url, success, size, seconds, cached)
+
+    def _send(self, url: str, success: bool, size: int, seconds: float, cached: bool):
+        """report of a page (in the background, a failed report is only counted)"""
+        async def send():
+            try:
+                rep = await self.pool.post(REPORT_URL, json={"url": url, "success": success, "bytes": size,
+                                                             "duration": int(seconds * 1000), "cached": cached})
+                rep.raise_for_status()
+            except httpx.HTTPError:
+                self.pool.metrics.inc("report_failures_total")
+        task = asyncio.create_task(send())
+        self._reports.add(task)
+        task.add_done_callback(self._reports.discard)
+
+    async def aclose(self):
+        """waits for the reports still being sent (must be called before the pool is closed)"""
+        await asyncio.gather(*self._reports, return_exceptions=True)
@@ -0,0 +1,94 @@
+"""
+Search of new mangas for the interactive mode of Sync.py (search engine, links and follows) :
+    - SearchCache : api responses kept on disk (FOLDER_PATH/.cache) by url, payload and account, for SEARCH_TTL seconds
+    - Pager : pages of results of a request, the next page is requested in the background while the current one is read
+    - tags : tags of MangaDex (/manga/tag), requested once and kept TAGS_TTL seconds, so a search can use tag names instead of ids
+"""
+
+import os # IO (makedirs, replace)
+import io # files
+import json # json handling
+import hashlib # names of the cached responses
+from time import time # time is time since Epoch
+from concurrent.futures import ThreadPoolExecutor, Future # next page requested in the background
+import requests as req
+from Globals import FOLDER_PATH, SEARCH_TTL, TAGS_TTL
+
+base = "https://api.mangadex.org" # base adress for the API endpoints
+
+
+class SearchCache:
+    """responses of the api on disk, one json file by url, payload and account"""
+    def __init__(self, folder: str = os.path.join(FOLDER_PATH, ".cache"), ttl: float = SEARCH_TTL) -> None:
+        self.folder = folder
+        self.ttl = ttl
+
+    def path(self, url: str, params: dict, headers: dict = None) -> str:
+        """file of a response (the account of the Authorization header is in the key, a follows page is only served to it)"""
+        auth = (headers or {}).get("Authorization", "")
+        account = hashlib.sha1(auth.encode()).hexdigest() if auth else None
+        key = hashlib.sha1(json.dumps([url, params, account], sort_keys=True).encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.json")
+
+    def get(self, url: str, params: dict, headers: dict = None, ttl: float = None) -> dict:
+        """
+        json of the response (from the cache if it is younger than ttl, else requested and saved)
+        failed requests aren't cached (AssertionError)
+        """
+        path = self.path(url, params, headers)
+        try:
+            with io.open(path, "r", encoding="UTF-8") as file:
+                entry = json.load(file)
+            if time() - entry["time"] < (self.ttl if ttl is None else ttl):
+                return entry["data"]
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        data = req.get(url, params=params, headers=headers).json()
+        assert data.get("result") == "ok", f"request failed : {data}"
+        os.makedirs(self.folder, exist_ok=True)
+        with io.open(f"{path}.part", "w", encoding="UTF-8") as file:
+            json.dump({"time": time(), "data": data}, file)
+        os.replace(f"{path}.part", path) # a page read while it is written by the prefetch is never half written
+        return data
+
+
+class Pager:
+    """pages of results of a request (payload['limit'] results by page, the first one is 1)"""
+    def __init__(self, cache: SearchCache, url: str, payload: dict, headers: dict = None) -> None:
+        self.cache = cache
+        self.url = url
+        self.payload = payload
+        self.headers = headers
+        self._executor = ThreadPoolExecutor(1)
+        self._pages: dict[int, Future] = {} # page : request (running or done)
+
+    def _request(self, page: int) -> dict:
+        return self.cache.get(self.url, {**self.payload, "offset": (page - 1) * self.payload["limit"]}, self.headers)
+
+    def _start(self, page: int):
+        if page not in self._pages:
+            self._pages[page] = self._executor.submit(self._request, page)
+
+    def is_last(self, page: int, data: dict) -> bool:
+        return page * self.payload["limit"] >= data["total"]
+
+    def get(self, page: int) -> dict:
+        """json of the page (waits for it if it is being prefetched), the next one is prefetched"""
+        self._start(page)
+        try:
+            data = self._pages[page].result()
+        except Exception:
+            del self._pages[page] # asked again at the next try
+            raise
+        if not self.is_last(page, data):
+            self._start(page + 1)
+        return data
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def tags(cache: SearchCache) -> dict[str, str]:
+    """name (lowercase) : id of every tag of MangaDex"""
+    data = cache.get(f"{base}/manga/tag", {}, ttl=TAGS_TTL)
+    return {name.lower(): t["id"] for t in data["data"] for name in t["attributes"]["name"].values()}
@@ -0,0 +1,62 @@
+"""
+Selection of the chapters to download from a feed (Feed.Chapter records), used by Sync.py and Index.py :
+    - one release by chapter number, chosen in one pass (dict by chapter) according to the policies :
+        - LANGUAGES : the first language of the list that has the chapter (fallback order)
+        - PREFERRED_GROUPS : the first scanlation group of the list that has the chapter (others after them)
+        - then the newest upload (publishAt)
+    - chapters already in the archive are passed (set lookup)
+    - credits of the scanlation groups, by chapter
+"""
+
+from Globals import LANGUAGES, PREFERRED_GROUPS
+from Feed import Chapter
+
+
+def chapter_order(chapter) -> float:
+    """sort key of a chapter number (str, None for oneshots)"""
+    try:
+        return float(chapter)
+    except (TypeError, ValueError): # None / 'None'
+        return 0.0
+
+def feed_order(c: Chapter) -> float:
+    """sort key of a chapter of a feed"""
+    return chapter_order(c.chapter)
+
+def release_rank(c: Chapter, languages: dict, groups: dict) -> tuple:
+    """(language rank, group rank) of a release, the lowest is the best"""
+    return languages.get(c.language, len(languages)), groups.get(c.group, len(groups))
+
+def select_chapters(chapters: list, present=(), languages: list = LANGUAGES, groups: list = PREFERRED_GROUPS) -> list:
+    """
+    one release by chapter number, without the chapters already present, sorted by chapter
+    param : chapters : list[Chapter] : chapters of a feed
+    param : present : chapter numbers already in the archive
+    param : languages, groups : list : preferred languages and scanlation groups, in order
+
+    output : list : chosen releases
+    """
+    present = set(str(p) for p in present)
+    languages = {lang: i for i, lang in enumerate(languages)}
+    groups = {group: i for i, group in enumerate(groups)}
+    best = {} # chapter number : (rank, release)
+    for c in chapters:
+        number = str(c.chapter)
+        if number in present:
+            continue
+        rank = release_rank(c, languages, groups)
+        if number not in best:
+            best[number] = (rank, c)
+            continue
+        bestRank, bestRelease = best[number]
+        if rank < bestRank or (rank == bestRank and c.publishAt > bestRelease.publishAt):
+            best[number] = (rank, c)
+    return sorted((c for _, c in best.values()), key=feed_order)
+
+def group_credits(chapters: list) -> dict[str, list]:
+    """scanlation group : its chapter numbers (sorted, without duplicates)"""
+    groups = {}
+    for c in chapters:
+        if c.group:
+            groups.setdefault(c.group, set()).add(c.chapter)
+    return {group: sorted(chaps, key=chapter_order) for group, chaps in groups.items()}
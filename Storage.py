@@ -0,0 +1,209 @@
+"""
+Storage of the pages, used by Sync.py, Verify.py and Converter.py :
+    - 0 : {vol}/{chap}/{page}.* and 1 : {vol}/{chap}-{page}.* : one file by page
+    - 2 : {vol}/{chap}.cbz : one uncompressed zip (ZIP_STORED) by chapter, the pages are added to it as they are downloaded
+      and its central directory is written when the chapter is closed (the .cbz is written as .cbz.part until then)
+the path of a page in a cbz is the path of the cbz followed by the name of the page (see Globals.page_path)
+pages are streamed to a temporary file (open_tmp, folders are created once), then saved by write_page in the threads of the
+writers stage of Sync.py (renamed, or added to the cbz), and the data of the disk can be flushed every FSYNC_BATCH pages
+"""
+
+import os # IO (stat, replace, remove)
+import shutil # copy of the pages into the cbz, by chunks
+import threading # pages written by many threads
+import zipfile # cbz files
+from contextlib import contextmanager # pages opened from a folder or a cbz
+from functools import lru_cache # content of the cbz files already read
+from Globals import CHUNK_SIZE, FSYNC_BATCH
+
+CBZ = 2 # fileSys of the cbz storage
+FILE_SYSTEMS = {
+    0: "vol/chap/page.*",
+    1: "vol/chap-page.*",
+    2: "vol/chap.cbz",
+}
+
+
+def cbz_entry(path: str) -> tuple[str, str]:
+    """(path of the cbz, name of the page) if the page is stored in a cbz, else None"""
+    cbz, sep, entry = path.rpartition(f".cbz{os.sep}")
+    return (f"{cbz}.cbz", entry) if sep else None
+
+@lru_cache(maxsize=256)
+def _cbz_sizes(path: str, mtime: float) -> dict[str, int]:
+    """name : size of the pages of a closed cbz (cached until the cbz changes)"""
+    with zipfile.ZipFile(path) as zf:
+        return {info.filename: info.file_size for info in zf.infolist()}
+
+def cbz_pages(path: str) -> dict[str, int]:
+    """name : size of the pages of a cbz (empty if it doesn't exist)"""
+    try:
+        return _cbz_sizes(path, os.stat(path).st_mtime)
+    except (FileNotFoundError, zipfile.BadZipFile):
+        return {}
+
+
+class CbzWriter:
+    """
+    cbz of a chapter being written in {cbz}.part (new pages are appended), moved in place once closed
+    (the pages of a cbz already saved are copied first, so an interrupted write never damages it)
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tmp_path = f"{path}.part"
+        _makedirs(os.path.dirname(path))
+        self._zip = zipfile.ZipFile(self.tmp_path, "w", compression=zipfile.ZIP_STORED)
+        try:
+            with zipfile.ZipFile(path) as src: # pages added to a chapter already saved
+                for info in src.infolist():
+                    with src.open(info) as file, self._zip.open(info.filename, "w", force_zip64=True) as dst:
+                        shutil.copyfileobj(file, dst, CHUNK_SIZE)
+        except (FileNotFoundError, zipfile.BadZipFile): # new chapter (or unreadable cbz : written again)
+            pass
+        self.sizes = {info.filename: info.file_size for info in self._zip.infolist()}
+        self._lock = threading.Lock() # one page written at a time in the zip
+
+    def add(self, entry: str, src: str):
+        """copies the file src in the cbz as entry (if it isn't already in it)"""
+        with self._lock:
+            if entry in self.sizes:
+                return
+            with open(src, "rb") as file, self._zip.open(entry, "w", force_zip64=True) as dst:
+                shutil.copyfileobj(file, dst, CHUNK_SIZE)
+            self.sizes[entry] = os.path.getsize(src)
+
+    def close(self):
+        """writes the central directory (and moves the cbz in place)"""
+        with self._lock:
+            self._zip.close()
+        os.replace(self.tmp_path, self.path)
+
+_writers: dict[str, CbzWriter] = {} # cbz being written : writer
+_lock = threading.Lock() # writers and fsync batch shared by the threads
+_folders: set[str] = set() # folders already created (set.add is atomic, a folder can only be created twice by a race)
+_unsynced = 0 # pages written since the last flush
+
+def _writer(cbz: str) -> CbzWriter:
+    with _lock:
+        if cbz not in _writers:
+            _writers[cbz] = CbzWriter(cbz)
+        return _writers[cbz]
+
+def _makedirs(folder: str):
+    """creates a folder once (the folders already created are cached)"""
+    if folder in _folders:
+        return
+    os.makedirs(folder, exist_ok=True)
+    _folders.add(folder)
+
+def _written():
+    """flushes the data of the disk every FSYNC_BATCH pages (0 : left to the os)"""
+    global _unsynced
+    if not FSYNC_BATCH or not hasattr(os, "sync"): # (not on Windows)
+        return
+    with _lock:
+        _unsynced += 1
+        if _unsynced < FSYNC_BATCH:
+            return
+        _unsynced = 0
+    os.sync() # one flush for the whole batch instead of one fsync by page
+
+
+# PAGES ===========================
+def exists(path: str) -> bool:
+    entry = cbz_entry(path)
+    if entry is None:
+        return os.path.exists(path)
+    if entry[0] in _writers:
+        return entry[1] in _writers[entry[0]].sizes
+    return entry[1] in cbz_pages(entry[0])
+
+def stat(path: str) -> tuple[int, float]:
+    """(size, mtime) of a page (mtime of its cbz for pages in a cbz), None if it is missing"""
+    entry = cbz_entry(path)
+    if entry is None:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_size, st.st_mtime
+    if entry[0] in _writers:
+        size = _writers[entry[0]].sizes.get(entry[1])
+        return (size, None) if size is not None else None
+    size = cbz_pages(entry[0]).get(entry[1])
+    return (size, os.stat(entry[0]).st_mtime) if size is not None else None
+
+def open_tmp(path: str):
+    """
+    temporary file where a page is downloaded before it is saved (its folder is created once)
+    output : (path of the temporary file, file opened for writing)
+    """
+    entry = cbz_entry(path)
+    tmp = f"{entry[0]}-{entry[1]}.part" if entry else f"{path}.part"
+    folder = os.path.dirname(tmp)
+    _makedirs(folder)
+    try:
+        return tmp, open(tmp, "wb")
+    except FileNotFoundError: # folder removed since it was cached
+        _folders.discard(folder)
+        _makedirs(folder)
+        return tmp, open(tmp, "wb")
+
+def write_page(tmp: str, path: str) -> tuple[int, float]:
+    """
+    saves a complete page from its temporary file (blocking, called in a writer thread) : renamed, or added to the cbz of the chapter
+    output : (size, mtime) of the page (see stat)
+    """
+    entry = cbz_entry(path)
+    if entry is None:
+        os.replace(tmp, path) # atomic on the same file system, an interrupted download never leaves a truncated page
+    else:
+        _writer(entry[0]).add(entry[1], tmp)
+        os.remove(tmp)
+    _written()
+    return stat(path)
+
+def pack(src: str, path: str):
+    """copies the page file src in its cbz (src is kept, to be removed once the cbz is closed)"""
+    entry = cbz_entry(path)
+    _writer(entry[0]).add(entry[1], src)
+
+def unpack(path: str, dst: str):
+    """copies a page of a cbz to the file dst"""
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with open_page(path) as page, open(f"{dst}.part", "wb") as file:
+        shutil.copyfileobj(page, file, CHUNK_SIZE)
+    os.replace(f"{dst}.part", dst)
+
+@contextmanager
+def open_page(path: str):
+    """binary file object to read a page"""
+    entry = cbz_entry(path)
+    if entry is None:
+        with open(path, "rb") as file:
+            yield file
+    else:
+        with zipfile.ZipFile(entry[0]) as zf, zf.open(entry[1]) as file:
+            yield file
+
+def remove(path: str):
+    """removes a page (a cbz is written again without it)"""
+    entry = cbz_entry(path)
+    if entry is None:
+        os.remove(path)
+        return
+    (cbz, name) = entry
+    with zipfile.ZipFile(cbz) as src, zipfile.ZipFile(f"{cbz}.part", "w", compression=zipfile.ZIP_STORED) as dst:
+        for info in src.infolist():
+            if info.filename != name:
+                with src.open(info) as file, dst.open(info.filename, "w", force_zip64=True) as out:
+                    shutil.copyfileobj(file, out, CHUNK_SIZE)
+    os.replace(f"{cbz}.part", cbz)
+
+def close_chapter(path: str):
+    """called once the pages of a chapter are done, closes its cbz if it has one (path : path of one of its pages)"""
+    entry = cbz_entry(path)
+    with _lock:
+        writer = _writers.pop(entry[0], None) if entry else None
+    if writer:
+        writer.close()
@@ -3,10 +3,16 @@ Simple script using the MangaDex public API to search and get/sync mangas and st
     - General infos :
         - don't have to be logged in to use it
         - you can update existant archives easily (U as 1st input)
-        - title is asked in console but tags must be added directly into the search payload (l.42)
-        - you can choose between two file system to save pictures, but if you want to change afterwards, you can use the FileSys_convert.py script
+        - title and tags (by name) are asked in console, the pages of results are cached and the next one is requested while you read
+        - you can choose between three file system to save pictures (two folder layouts or one cbz by chapter), but if you want to change afterwards, you can use the Converter.py script
         - .json files are used to store responses from the server and are kept after sync, so it is possible to read them
+          (the chapters of each manga are in chapters.jsonl, one chapter by line, appended as the feed arrives)
         - you can stop the script halfway in and restart it after, it will pass already dowloaded pictures (so the script can update mangas already synced before with only the new content)
+    - Headless mode (no console input, for cron or a service), ex :
+        - python Sync.py --update : updates the whole library (or only the folders given after --update)
+        - python Sync.py --add {id or link} --quality 1 --layout 2 : syncs new mangas
+        - python Sync.py --watch 3600 : updates the library every hour, with the same clients and token
+        - see python Sync.py --help (the arguments can also be given in a json file with --config)
 Link to the MangaDex API documentation : https://api.mangadex.org/docs.html
     
     Made by Merlet Raphael, 2021
@@ -14,52 +20,80 @@ Link to the MangaDex API documentation : https://api.mangadex.org/docs.html
 
 
 import httpx # async requests
-import requests as req
-import jwt
 from rich import print # pretty print
-from rich.progress import * # progress bar
+import io # files
 import json # json handling
 import os # IO (mkdir)
 import asyncio # used to run async func
+import argparse # headless mode
+import sys # arguments
+import hashlib # check the pages while they are downloaded
+from datetime import datetime, timezone # timestamp of the last sync (updatedAtSince)
 from getpass import getpass # to get password without echo on terminal
-from time import perf_counter, sleep, time # time is time since Epoch
-from threading import Thread # Permet de faire tourner des fonctions en meme temps (async)
-from Globals import __AUTHOR__, __VERSION__, FOLDER_PATH, LOGIN_PATH, format_title, SIMULTANEOUS_REQUESTS
+from time import perf_counter, time # time is time since Epoch
+from Engine import Engine, AdaptiveLimit # single event loop download pipeline
+from Network import ClientPool, AtHomeCache, NodeHealth, UPLOADS_URL, backoff, is_retryable # keep-alive clients shared by host
+from Metrics import Metrics # counters and latencies of the run
+from Index import ArchiveIndex # SQLite index of the archive
+from Verify import CorruptPageError, filename_hash, verify_pages # integrity of the pages
+import Storage # pages in folders or cbz
+from Feed import Chapter, FeedFile # chapters.jsonl
+from Selection import select_chapters, group_credits, chapter_order, feed_order # one release by chapter
+import Globals # paths of a library (see set_library)
+from Globals import __AUTHOR__, __VERSION__, FOLDER_PATH, LOGIN_PATH, format_title, page_path, SIMULTANEOUS_REQUESTS, SIMULTANEOUS_MANGAS, SIMULTANEOUS_PAGES, QUEUE_SIZE, CHUNK_SIZE, PAGE_RETRIES, AT_HOME_RETRIES, LANGUAGES, DISCOVERY_BATCH, WATCH_INTERVAL, METRICS_PATH, INDEX_PATH, PROMETHEUS_PATH, ADAPTIVE_CONCURRENCY, MAX_SIMULTANEOUS_REQUESTS, MAX_SIMULTANEOUS_PAGES, WRITE_WORKERS, WRITE_QUEUE_SIZE, WRITE_BUFFER, SIMULTANEOUS_CHAPTERS_BY_MANGA, BACKFILL_CHAPTERS, TOKEN_REFRESH_MARGIN
 
 base = "https://api.mangadex.org" # base adress for the API endpoints
+MAX_OFFSET = 10000 # max offset + limit of the lists of the api
 
 class Account:
-    """classe qui gère le login et la validité du token, et renvoie le bearer de connexion"""
-    def __init__(self, login_path=LOGIN_PATH) -> None:
+    """
+    classe qui gère le login et la validité du token, et renvoie le bearer de connexion
+    the expiry of the token is decoded once, and during a sync the token is refreshed in the background TOKEN_REFRESH_MARGIN seconds
+    before it expires (one refresh shared by every worker), on_tokens is called with the new bearer (headers of the api client)
+    """
+    def __init__(self, login_path=LOGIN_PATH, interactive: bool = True) -> None:
         self.login_path = login_path
+        self.interactive = interactive # False in headless mode : the credentials are never asked
         self.connected = False
+        self.on_tokens = None # func called with the bearer when the tokens change
         self._token = ""
         self._refresh_token = ""
+        self._expires = 0.0 # time (since Epoch) when the token expires
         self._user = ""
-            
+        self._refreshing: asyncio.Task = None # refresh in progress (shared by the workers)
+        self._keepAlive: asyncio.Task = None # background refresh of the session
+
+    def _set_tokens(self, token: str, refresh_token: str):
+        """keeps the tokens and the expiry of the token (decoded once), and saves them"""
+        self._token = token
+        self._refresh_token = refresh_token
+        import jwt # (only needed once logged in)
+        try:
+            self._expires = jwt.decode(token, algorithms=["RS256"], options={"verify_signature": False})['exp']
+        except (jwt.DecodeError, KeyError):
+            self._expires = 0.0
+        if token:
+            with io.open(self.login_path, 'w+' if os.path.exists(self.login_path) else 'x+') as file:
+                json.dump({'token': token, 'refresh_token': refresh_token}, file)
+        if self.on_tokens:
+            self.on_tokens(self.bearer)
+
     def login(self):
         """front login func (console input)"""
         username = input('username : ')
         password = getpass('password : ')   
         self._user = username
         self._pwd = password
-        self._token, self._refresh_token = self.__login()
-        with io.open(self.login_path, 'w+' if os.path.exists(self.login_path) else 'x+') as file:
-            txt = {
-                'token': self._token,
-                'refresh_token': self._refresh_token
-            }
-            json.dump(txt, file)
+        self._set_tokens(*self.__login())
         
         return self._token, self._refresh_token
     
     def relogin(self, token: str, refresh_token: str):
         """front relogin func, using __refresh_token if necessary (if valid refresh token found at login_path)"""
-        self._token = token
-        self._refresh_token = refresh_token
-        if self.isExpired:
-            self._token, self._refresh_token = self.__refresh_login()
         self.connected = True
+        self._set_tokens(token, refresh_token)
+        if self.isExpired:
+            self._set_tokens(*self.__refresh_login())
         return self._token
 
     def __login(self) -> tuple[str, str]:
@@ -70,6 +104,7 @@ class Account:
             'password': self._pwd
         }
 
+        import requests as req
         rep = req.post(f'{base}/auth/login', json=payload)
         repJson = rep.json()
         assert repJson['result'] == 'ok', 'login failed (invalid credentials ?) : {}'.format(repJson) # check if login succeded
@@ -77,45 +112,90 @@ class Account:
         self.connected = True
         return repJson['token']['session'], repJson['token']['refresh']
 
-    def __refresh_login(self):
+    def __refresh_login(self, ask: bool = True):
+        """param : ask : bool : the credentials can be asked if the refresh token is expired (never during a sync)"""
+        import requests as req
         rep = req.post(f'{base}/auth/refresh', json={'token': self._refresh_token})
         repJson = rep.json()
         if repJson['result'] == 'ok':
             return repJson['token']['session'], repJson['token']['refresh']
-        else:
-            return self.__login() if self._user else self.login()
+        elif self._user:
+            return self.__login()
+        elif self.interactive and ask:
+            return self.login()
+        else: # headless : continues without login
+            print('[bold red]login expired (run Sync.py without arguments to login again), continuing without login')
+            self.connected = False
+            return "", ""
     
     @property
     def isExpired(self) -> bool:
-        token = self._token
-        try:
-            data = jwt.decode(token, algorithms=["RS256"], options={"verify_signature": False})
-        except jwt.DecodeError:
-            return True
-        return time() > data['exp']
+        return time() > self._expires
+
+    @property
+    def isExpiring(self) -> bool:
+        """the token expires in less than TOKEN_REFRESH_MARGIN seconds (or is expired)"""
+        return self.connected and time() > self._expires - TOKEN_REFRESH_MARGIN
 
     @property
     def token(self) -> str:
-        if self.isExpired:
-            self._token, self._refresh_token = self.__refresh_login()
+        """token, refreshed now if it is expired (blocking : outside of a sync)"""
+        if self.isExpired and self.connected:
+            self._set_tokens(*self.__refresh_login())
         return self._token
     
     @property
     def bearer(self) -> dict[str, str]:
-        return {'Authorization': 'Bearer ' + self.token} if self.connected else {}
+        return {'Authorization': 'Bearer ' + self._token} if self.connected else {}
+
+    async def refresh(self):
+        """refreshes the tokens in a thread, once for all the workers asking at the same time"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.create_task(self._refresh())
+        await asyncio.shield(self._refreshing)
 
-def get_manga(*args):
+    async def _refresh(self):
+        try:
+            self._set_tokens(*await asyncio.to_thread(self.__refresh_login, False))
+        finally:
+            self._refreshing = None
+
+    async def _keep_alive(self):
+        import requests as req
+        while self.connected:
+            await asyncio.sleep(max(self._expires - TOKEN_REFRESH_MARGIN - time(), 0))
+            if not self.isExpiring: # refreshed meanwhile (by run_sync, after the event loop was idle)
+                continue
+            try:
+                await self.refresh()
+            except (req.RequestException, AssertionError, KeyError) as e: # network down... : tried again later, the token may still be valid
+                print(f"[bold red]token refresh failed : {e}")
+                await asyncio.sleep(backoff(3))
+
+    def start_refresh(self):
+        """starts the background refresh of the tokens (in the running event loop, once)"""
+        if self.connected and (self._keepAlive is None or self._keepAlive.done()):
+            self._keepAlive = asyncio.create_task(self._keep_alive())
+
+    def stop_refresh(self):
+        if self._keepAlive:
+            self._keepAlive.cancel()
+            self._keepAlive = None
+
+async def get_manga(*args):
     """
-    called for each chapter concurrently, take care of doing the requests and saving the pages
+    called for each manga by the engine, gathers the feed (if the new chapters weren't found by discover_chapters)
+    and submits the new chapters to the chapters stage
+    (syncStart : time taken by run_sync before any request, saved as lastSync once the manga is done)
     """
-    client = httpx.Client(headers=account.bearer)
-    #print(client.headers)
-    (fsChoice, qChoice, idManga, name, presentChapters) = args
+    (fsChoice, qChoice, idManga, name, presentChapters, lastSync, newChapters, syncStart) = args
 
     def update_infos():
+        # only the chapters done are added, and lastSync stays before the failed ones so the next update asks them again
+        done = set(index.chapter_list(idManga))
+        newPresentChapters = sorted(set([chapter.chapter for chapter in chapters if chapter.chapter in done]), key=chapter_order)
+        newSync = syncStart if all(chapter.chapter in done for chapter in chapters) else lastSync
         with io.open(f"{FOLDER_PATH}/{name}/infos.json", "w+", encoding="UTF-8") as file: # updates infos.json for new chapters
-            newPresentChapters = list(set([chapter["attributes"]["chapter"] for chapter in chapters]))
-            newPresentChapters.sort(key=lambda c: (float(c) if c != None else 0))
 
             mangaInfos = {
                 "fileSys" : fsChoice,
@@ -123,15 +203,14 @@ def get_manga(*args):
                 "id": idManga,
                 "name" : name,
                 "chapterList": presentChapters + newPresentChapters,
+                "lastSync": newSync,
                 "scanlator groups, by chapters done (credits)" : groups
             }
             json.dump(mangaInfos, file)
+        index.add_manga(idManga, name, fsChoice, qChoice, newSync)
 
     payloadManga = {
-        "translatedLanguage[]": [
-            #"fr", 
-            "en"
-        ],
+        "translatedLanguage[]": LANGUAGES,
         "limit": 500,
         "offset": 0,
         "includeFutureUpdates": "0",
@@ -139,462 +218,490 @@ def get_manga(*args):
         'order[volume]': 'asc',
         'order[chapter]': 'asc'
     }  
-    
-    with io.open(os.path.join(FOLDER_PATH, name, "chapters.json"), "w+", encoding="UTF-8") as file:
-        r3 = client.get(f"{base}/manga/{idManga}/feed", params=payloadManga)
-        while r3.status_code == 429:
-            sleep(1.0)
-            r3 = client.get(f"{base}/manga/{idManga}/feed", params=payloadManga)
-        mangaFeed = r3.json()
-        chapters = mangaFeed['data']
-        # if manga have 500+ chapters
-        while mangaFeed['total'] > (len(mangaFeed['data']) + 500*mangaFeed['offset']):
-            mangaFeed['offset'] += 1 
-            r3 = client.get(f"{base}/manga/{idManga}/feed", params=payloadManga)
-            while r3.status_code == 429:
-                sleep(1.0)
-                r3 = client.get(f"{base}/manga/{idManga}/feed", params=payloadManga)
-            mangaFeed = r3.json()
-            chapters += mangaFeed['data']
-        json.dump(chapters, file)
+    # only the chapters updated since the last sync are asked (the whole feed for a new manga)
+    if lastSync:
+        payloadManga["updatedAtSince"] = lastSync
+
+    feed = FeedFile(os.path.join(FOLDER_PATH, name)) # chapters.jsonl
+
+    async def get_feed_page(offset: int) -> tuple[int, int, list]:
+        """output : (total, limit, chapters of the page), the chapters are saved as soon as they arrive"""
+        # rate limits (and 429) are handled by the pool
+        r3 = await pool.get(f"{base}/manga/{idManga}/feed", params={**payloadManga, "offset": offset}) # (bearer in the headers of the api client)
+        r3.raise_for_status()
+        feedPage = r3.json()
+        chapters = [Chapter.from_api(c) for c in feedPage['data']]
+        feed.append(chapters)
+        return feedPage['total'], feedPage['limit'], chapters
+
+    if newChapters is None: # not found by discover_chapters, crawl the feed
+        if not lastSync: # whole feed : written again
+            feed.clear()
+        with metrics.timer("feed_seconds"):
+            (total, limit, newChapters) = await get_feed_page(0)
+            # if manga have 500+ chapters, the other pages are gathered at the same time once the total is known
+            for (_, _, chapters) in await asyncio.gather(*(get_feed_page(offset) for offset in range(limit, total, limit))):
+                newChapters += chapters
+    else:
+        feed.append(newChapters)
+    # chapters of the previous syncs and the new ones (last record of each chapter)
+    allChapters = sorted(feed.load().values(), key=feed_order)
+    index.add_manga(idManga, name, fsChoice, qChoice, lastSync)
+    index.add_chapters(idManga, allChapters, presentChapters)
     # search all present scanlation groups for credits
-    groups = {}
-    for c in chapters:
-        group = [r['attributes']['name'] for r in c['relationships'] if r['type'] == 'scanlation_group']
-        if group:
-            group = group[0]
-            if group in groups.keys():
-                groups[group].append(c['attributes']['chapter'])
-            else:
-                groups[group] = [c['attributes']['chapter']]
-    for group_name, chaps in groups.items():
-        groups[group_name] = sorted(list(set(chaps)), key=lambda c: float(c) if c else 0)
-    # clean the list of chapters to 
-    with io.open(os.path.join(FOLDER_PATH, name, "chapters.json"), "r", encoding="UTF-8") as file:
-        chapters = json.load(file)
-        # remove duplicates and already present chapters                     
-        n = 'aaaaa'                           
-        for c in chapters:
-            ni = c["attributes"]["chapter"]
-            if ni == n:
-                chapters.remove(c)
-            else:
-                n = ni
-        chapters = [c for c in chapters if str(c["attributes"]["chapter"]) not in presentChapters]
+    groups = group_credits(allChapters)
+    # one release by new chapter (languages and groups preferred in Globals, then the newest), without the chapters already present
+    chapters = select_chapters(newChapters, presentChapters)
 
+    metrics.inc("chapters_total", len(chapters))
     taskId = prgbar.add_task(name, total=len(chapters) if chapters else 1)
     if not chapters: # if there is no new chapters, fill progress bar and quit func
         prgbar.update(taskId, description=f'{name} (no new chapters)', advance=1)
-        sleep(1.0)
+        if not prgbar.disable: # (shown a moment, no wait without a progress bar)
+            await asyncio.sleep(1.0)
         prgbar.remove_task(taskId)
         update_infos()
         return
-    # setup chapter tasks
-    done_tasks = 0
-    tasks = [Thread(target=get_chapter_data, args=(c, qChoice, name, fsChoice, taskId)) 
-            for c in chapters[:SIMULTANEOUS_REQUESTS]]
-    initial_tasks = len(tasks)
-    for task in tasks:    
-        task.start()
-    not_done = True
-    while not_done:
-        for task in tasks:
-            #print(len(chapters))
-            #print(initial_tasks + done_tasks)
-            if not task.is_alive():
-                if len(chapters) > initial_tasks + done_tasks: # if there is remaining tasks to add
-                    i = tasks.index(task)
-                    c = chapters[SIMULTANEOUS_REQUESTS + done_tasks]
-                    new_task = Thread(target=get_chapter_data, args=(c, qChoice, name, fsChoice, taskId))
-                    new_task.start()
-                    tasks[i] = new_task
-                    done_tasks += 1
-                else:
-                    not_done = False
-        sleep(.1)
-    while any([task.is_alive() for task in tasks]): sleep(.1)
+    # the new releases of the mangas already synced go first, backfills (new manga, or many chapters late) after them
+    priority = 1 if not lastSync or len(chapters) > BACKFILL_CHAPTERS else 0
+    # submit the chapters to the engine (waits when the queue of this manga is full) and wait for all of them
+    # the M@H server of a chapter is resolved while the previous one of the manga downloads (one ahead : the 40/min of /at-home/server
+    # aren't spent on chapters far in the queue, whose adress could expire before they start)
+    atHome.prefetch(chapters[0].id)
+    tasks = []
+    for (c, nextChapter) in zip(chapters, chapters[1:] + [None]):
+        tasks.append(await engine['chapters'].submit(c, qChoice, name, fsChoice, taskId, priority, nextChapter and nextChapter.id,
+                                                     key=name, priority=priority))
+    await asyncio.gather(*tasks, return_exceptions=True)
 
     update_infos()
     prgbar.update(taskId, description=f'{name} ({len(chapters)} new chapters)', advance=1)
 
-def get_chapter_data(*args):
+async def discover_chapters(manga_jobs: list) -> list:
+    """
+    update mode : asks /chapter for the chapters updated since the last sync of many mangas at once (manga[] ids),
+    instead of one feed crawl by manga, so a sync without new chapters only costs a few requests
+    param : manga_jobs : list : args of get_manga for each manga (from get_param_manga)
+
+    output : list : the same jobs, with the chapters found for each manga already synced once
+    (the others keep None : feed crawl, like the mangas of a batch that failed or that has more chapters than the api can list)
+    """
+    synced = {job[2]: job[5] for job in manga_jobs if job[5]} # idManga : lastSync
+    found = {idManga: [] for idManga in synced}
+    ids = list(synced.keys())
+    for i in range(0, len(ids), DISCOVERY_BATCH):
+        batch = ids[i:i+DISCOVERY_BATCH]
+        payloadChapters = {
+            "manga[]": batch,
+            "translatedLanguage[]": LANGUAGES,
+            "updatedAtSince": min(synced[idManga] for idManga in batch),
+            "limit": 100,
+            "includeFutureUpdates": "0",
+            "includes[]": ['scanlation_group'],
+            "contentRating[]": [
+                "safe",
+                "suggestive",
+                "erotica",
+                "pornographic"
+            ],
+            "order[updatedAt]": "asc"
+        }
+
+        async def get_chapters_page(offset: int) -> dict:
+            rep = await pool.get(f"{base}/chapter", params={**payloadChapters, "offset": offset})
+            rep.raise_for_status()
+            return rep.json()
+
+        try:
+            chaptersPage = await get_chapters_page(0)
+            if chaptersPage['total'] > MAX_OFFSET: # (offset + limit is capped by the api)
+                raise ValueError(f"{chaptersPage['total']} chapters updated")
+            chapters = chaptersPage['data']
+            for otherPage in await asyncio.gather(*(get_chapters_page(offset) for offset in range(chaptersPage['limit'], chaptersPage['total'], chaptersPage['limit']))):
+                chapters += otherPage['data']
+        except (httpx.HTTPError, ValueError) as e: # the feeds of this batch are crawled instead
+            print(f"[bold red]Discovery of {len(batch)} mangas failed ({e}), their feeds are crawled")
+            for idManga in batch:
+                found[idManga] = None
+            continue
+        # fan out the chapters to their mangas (the batch uses the oldest lastSync, so the others are filtered again)
+        for c in chapters:
+            c = Chapter.from_api(c)
+            if found.get(c.manga) is not None and c.updatedAt[:19] > synced[c.manga]:
+                found[c.manga].append(c)
+    return [job[:6] + (found.get(job[2]),) for job in manga_jobs]
+
+async def get_chapter_data(*args):
     """
-    Get all pages from imgPaths from the chapter with the hash
+    called for each chapter by the engine, gets the M@H adress of the chapter and submits its missing pages to the pages stage
     args:
-        - c : json dictionary with chapter infos
+        - c : Chapter : record of the chapter
         - quality : bool : if the images are compressed (jpg) or not (png)
         - name : str : name of manga
+        - fsChoice : int : file system of the manga
+        - idTask : id of the progress bar task of the manga
+        - priority : int : priority of the manga in the scheduler (0 : new releases, 1 : backfill), given to its pages
+        - idNext : str : id of the next chapter of the manga (its M@H server is prefetched), None for the last one
 
     output : int : number of added images
     """
-    (c, quality, name, fsChoice, idTask) = args
-    sync_client = httpx.Client(headers=account.bearer)
+    (c, quality, name, fsChoice, idTask, priority, idNext) = args
+    if idNext:
+        atHome.prefetch(idNext)
 
-    async def request_images() -> list:
+    async def request_images() -> int:
         """
-        requests the image to a server asynchronously
+        requests the images of the chapter to the pages workers
         """
-        atHome_payload = {'forcePort443': True}
         #print("request_images chap {} vol {}".format(chap, vol))
-        baseServer = 'https://uploads.mangadex.org'
-        # Ask an adress for M@H for each chapter
-        # Will make sure it will always use the good adress, but is rate limited at 40 reqs/min and slow to do
-        rServ = sync_client.get(f"{base}/at-home/server/{id}", params=atHome_payload)
-        
-        while rServ.status_code == 429 or rServ.json()['result'] != 'ok': # request failed
-            if 'X-RateLimit-Retry-After' in rServ.headers.keys():
-                time_to_wait = float(rServ.headers['X-RateLimit-Retry-After']) - time()
-            else:
-                time_to_wait = 10.0
-            await asyncio.sleep(time_to_wait)
-            #sync_client.headers = account.bearer # check if token is still valid
-            rServ = sync_client.get(f"{base}/at-home/server/{id}", params=atHome_payload)
-            
-        dataServer = rServ.json()
-        baseServer = dataServer["baseUrl"]
-        hash = dataServer["chapter"]["hash"]
-        imgPaths = dataServer["chapter"][("data" if quality else "dataSaver")] # ["dataSaver"] for jpg (smaller size)
-        # filtering of existent images
-        if fsChoice:    
-            imgsToGet = [img for img in imgPaths 
-            if not os.path.exists(
-                os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", 
-                            f"chap-{chap}-{title}-p{imgPaths.index(img)+1}.{fileFormat}"))]
-        else:
-            imgsToGet = [img for img in imgPaths 
-            if not os.path.exists(
-                os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}",
-                            f"chap-{chap}-{title}", f"page-{imgPaths.index(img)+1}.{fileFormat}"))]
+
+        async def resolve_server(refresh: bool = False) -> tuple[str, list[str]]:
+            """asks an adress for M@H, output : (base adress of the chapter, filenames of the pages)"""
+            # Will make sure it will always use the good adress, but is rate limited at 40 reqs/min (paced by the pool) and slow to do,
+            # so it is usually already resolved (prefetched by get_manga while the chapter was waiting in the queue)
+            with metrics.timer("at_home_wait_seconds"): # ~0 if it was prefetched
+                dataServer = await atHome.get(id, refresh) # request failed : the chapter is skipped
+                if nodes.degraded(dataServer["baseUrl"]) and not refresh: # node already failing for other chapters : another one is asked
+                    metrics.inc("at_home_refresh_total")
+                    dataServer = await atHome.get(id, refresh=True)
+            baseServer = dataServer["baseUrl"]
+            if nodes.degraded(baseServer): # no healthy node given : main server of MangaDex
+                metrics.inc("node_fallback_total")
+                baseServer = UPLOADS_URL
+            hash = dataServer["chapter"]["hash"]
+            adress = f"{baseServer}/data/{hash}" if quality else f"{baseServer}/data-saver/{hash}"
+            return adress, dataServer["chapter"][("data" if quality else "dataSaver")] # ["dataSaver"] for jpg (smaller size)
+
+        adress, imgPaths = await resolve_server()
+        # filtering of existent images with the index (page numbers start at 1)
+        # pages saved before the archive was indexed are found by get_page, which only checks their path
+        pagesDone = index.pages_done(id)
+        pagesToGet = [page for page in range(1, len(imgPaths)+1) if page not in pagesDone]
         # if there is no images to get, exits
-        if not imgsToGet:
-            return []
-        # else, setup an async client and gather the images
-        adress = f"{baseServer}/data/{hash}/" if quality else f"{baseServer}/data-saver/{hash}"
-        async with httpx.AsyncClient(base_url=adress, timeout=1000) as client:
-            retries_left = 5
-            try:
-                tasks = (client.get(f"/{img}") for img in imgsToGet)  
-                reqs = await asyncio.gather(*tasks)   
-                status_code_errors = [req.status_code for req in reqs if str(req.status_code)[0] != '2']
-            except httpx.ReadError:
-                status_code_errors = ['read error']
-            except httpx.ConnectTimeout:
-                status_code_errors = ['connect timeout']
-            except httpx.RemoteProtocolError:
-                status_code_errors = ['remote protocol error']
-
-            while status_code_errors and retries_left:
-                print(f'An exception occurred when gathering chap {chap} images with the status code(s) {", ".join(status_code_errors)} (will retry {retries_left} more times)')
-                retries_left -= 1
-                await asyncio.sleep(1)
-                try:
-                    tasks = (client.get(f"/{img}") for img in imgsToGet)  
-                    reqs = await asyncio.gather(*tasks)   
-                    status_code_errors = [req.status_code for req in reqs if str(req.status_code)[0] != '2']
-                except httpx.ReadError:
-                    status_code_errors = ['read error']
-                except httpx.ConnectTimeout:
-                    status_code_errors = ['connect timeout']
-                except httpx.RemoteProtocolError:
-                    status_code_errors = ['remote protocol error']
-            if status_code_errors:
-                print(f"Chap {chap} ignored because 5 exceptions occured")
-                images = []
-            else:
-                images = [rep.content for rep in reqs]
+        if not pagesToGet:
+            close_chapter(id, firstPage)
+            index.chapter_done(id, len(imgPaths))
+            return 0
+        # else, submit them to the engine (each page is retried by its worker, the client of the node is shared with the other chapters)
+        new_imgs = 0
+        for resolves_left in range(AT_HOME_RETRIES, -1, -1):
+            tasks = [await engine['pages'].submit(f"{adress}/{imgPaths[page-1]}", page_path(name, vol, chap, title, page, fileFormat, fsChoice, FOLDER_PATH), id, page,
+                                                  key=name, priority=priority)
+                     for page in pagesToGet]
+            reqs = await asyncio.gather(*tasks, return_exceptions=True)
+            new_imgs += sum(rep for rep in reqs if not isinstance(rep, Exception))
+            status_code_errors = [describe_error(rep) for rep in reqs if isinstance(rep, Exception)]
+            # pages already saved are kept, only the failed ones are requested again
+            pagesToGet = [pagesToGet[i] for i in range(len(reqs)) if isinstance(reqs[i], Exception)]
+            if not pagesToGet:
+                break
+            if not resolves_left:
+                print(f"Chap {chap} incomplete : {len(pagesToGet)} page(s) failed ({', '.join(status_code_errors)})")
+                break
+            # the pages failed after all their retries : the node is failing, ask for another one
+            print(f'{len(pagesToGet)} page(s) of chap {chap} failed with the status code(s) {", ".join(status_code_errors)} (asking for a new M@H server, {resolves_left} more times)')
+            metrics.inc("at_home_refresh_total")
+            adress, imgPaths = await resolve_server(refresh=True)
+        close_chapter(id, firstPage) # (its pages are indexed before the chapter is done)
+        index.chapter_done(id, len(imgPaths), complete=not pagesToGet)
  
-        return images
+        return new_imgs
 
     # chapter infos
-    vol = c["attributes"]["volume"]
-    chap = c["attributes"]["chapter"]
+    vol = c.volume
+    chap = c.chapter
     fileFormat = "png" if quality else "jpg"
-    id = c["id"]
+    id = c.id
     # get the title
     try:
-        if not c["attributes"]["title"]:
+        if not c.title:
             title = "NoTitle"
-        title = format_title(c["attributes"]["title"])
+        title = format_title(c.title)
     except Exception:
         title = "NoTitle"
+    firstPage = page_path(name, vol, chap, title, 1, fileFormat, fsChoice, FOLDER_PATH) # (its cbz, if the chapter has one)
     # check for already downloaded images in directory
-    loop = asyncio.new_event_loop()
     try:
-        images = loop.run_until_complete(request_images())
-    except RuntimeError as e:
-        print("image gathering for chapter {} encountered an error when closing (will be skipped) : {} ".format(chap, e))
-        images = []
+        with metrics.timer("chapter_seconds"):
+            new_imgs = await request_images()
+    except (RuntimeError, httpx.HTTPError) as e:
+        print("image gathering for chapter {} encountered an error (will be skipped) : {} ".format(chap, e))
+        metrics.inc("chapter_failures_total")
+        engine['chapters'].error()
+        new_imgs = 0
+    finally:
+        atHome.done(id)
+        close_chapter(id, firstPage) # central directory of the cbz (if it failed)
 
     prgbar.update(idTask, description=f'{name} (vol {vol} chap {chap})', advance=1)
-    task = Thread(target=save_chapter, args=(images, name, vol, chap, title, fileFormat, fsChoice))
-    task.start()
-    task.join()
+    return new_imgs
+
+def describe_error(e: Exception) -> str:
+    """short description of an exception raised by a page request (status code or error type)"""
+    if isinstance(e, httpx.HTTPStatusError):
+        return str(e.response.status_code)
+    if isinstance(e, httpx.ReadError):
+        return 'read error'
+    if isinstance(e, httpx.ConnectTimeout):
+        return 'connect timeout'
+    if isinstance(e, httpx.RemoteProtocolError):
+        return 'remote protocol error'
+    if isinstance(e, CorruptPageError):
+        return 'corrupt page'
+    return type(e).__name__
 
-def save_chapter(*args) -> int:
+async def get_page(*args) -> int:
     """
-    called by get_chapter_pages saves the images of the chapter in the correct folder
-    param : images : list[bytes] : list of all the pages in bytes
-    param : name, vol, chap, title : infos of the chapter
+    called for each page by the engine, streams the page to a temporary file (hashed as it arrives) and gives it to the writers stage
+    (the page is written by batches of WRITE_BUFFER bytes in a thread, so the disk never blocks the event loop and at most two batches
+    of the page are in memory, and the download waits while the writers are behind)
+    network errors, 5xx and pages not matching the hash of their filename are retried PAGE_RETRIES times with a jittered exponential backoff,
+    unless the node is degraded (the chapter asks for another one), the result of each try is recorded for the node and reported to M@H
+    args:
+        - url : str : adress of the page on M@H
+        - path : str : where the page must be saved
+        - idChapter, page : id of the chapter and number of the page (for the index)
 
-    sortie : int : number of new images saved for this chapter
+    output : int : number of added images (0 or 1)
     """
-    (images, name, vol, chap, title, fileFormat, fsChoice) = args
-    new_imgs = 0
-    for img in images:
+    (url, path, idChapter, page) = args
+    filename = url.split('/')[-1]
+    if Storage.exists(path): # saved before the archive was indexed
+        add_page(idChapter, page, filename, path, Storage.stat(path)[0])
+        return 0
+    expected = filename_hash(filename)
+    tmp = None
+    for attempt in range(PAGE_RETRIES + 1):
         try:
-            if fsChoice:
-                # NORMAL FILE SYSTEM ({vol}/{chap}-{page}.*)
-                # (easier for browsing pictures but harder to view in explorer)
-                try:
-                    os.makedirs(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}")) # create folder
-                except Exception:
-                    pass
-                with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}-p{images.index(img)+1}.{fileFormat}"), "x+") as file:
-                    # write data to file
-                    file.buffer.write(img)
-            else:
-                # ==============================================================
-                # OTHER FILE SYSTEM ({vol}/{chap}/{page}.*)
-                # (easier for browsing in explorer but reading is harder)
-                try:
-                    os.makedirs(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}")) # create folder
-                except Exception:
-                    pass
-                with io.open(os.path.join(FOLDER_PATH, name, "chapters", f"vol-{vol}", f"chap-{chap}-{title}", f"page-{images.index(img)+1}.{fileFormat}"), "x+") as file:
-                    # write data to file
-                    file.buffer.write(img)
-            new_imgs += 1
-        except FileExistsError:
-            pass
+            sha = hashlib.sha256() # checked while the page is streamed
+            received = 0
+            cached = False
+            start = perf_counter()
+            with metrics.timer("page_download_seconds"):
+                async with pool.stream("GET", url) as rep:
+                    cached = rep.headers.get("X-Cache", "").startswith("HIT")
+                    rep.raise_for_status()
+                    (tmp, file) = await asyncio.to_thread(Storage.open_tmp, path) # (creates the folder once)
+                    batch = bytearray()
+                    writing = None # write of the previous batch, running in a thread while the next one is downloaded
+                    try:
+                        async for chunk in rep.aiter_bytes(CHUNK_SIZE):
+                            sha.update(chunk)
+                            received += len(chunk)
+                            batch += chunk
+                            if len(batch) >= WRITE_BUFFER:
+                                if writing:
+                                    await writing
+                                writing = asyncio.ensure_future(asyncio.to_thread(file.write, batch))
+                                batch = bytearray()
+                        if writing:
+                            await writing
+                        writing = asyncio.ensure_future(asyncio.to_thread(file.write, batch)) if batch else None
+                        if writing:
+                            await writing
+                    finally:
+                        if writing: # (the file is never closed while a thread writes in it)
+                            await asyncio.gather(writing, return_exceptions=True)
+                        await asyncio.to_thread(file.close)
+            if expected and sha.hexdigest() != expected:
+                raise CorruptPageError(f"{filename} doesn't match its hash")
+            nodes.record(url, True, received, perf_counter() - start, cached)
+            # saved by the writers stage (renamed, or added to the cbz of the chapter)
+            (size, mtime) = await (await engine['writes'].submit(tmp, path))
+            add_page(idChapter, page, filename, path, size, mtime if expected else None)
+            metrics.inc("pages_total")
+            metrics.inc("page_bytes_total", size)
+            return 1
+        except (httpx.TransportError, httpx.HTTPStatusError, CorruptPageError) as e:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+            nodes.record(url, False, received, perf_counter() - start, cached)
+            if attempt == PAGE_RETRIES or not (is_retryable(e) or isinstance(e, CorruptPageError)) or nodes.degraded(url):
+                metrics.inc("page_failures_total", error=describe_error(e))
+                raise
+            metrics.inc("page_retries_total", error=describe_error(e))
+            if isinstance(e, httpx.HTTPStatusError) and e.response.status_code == 429: # fewer pages at the same time, now
+                engine['pages'].congestion()
+            elif is_retryable(e):
+                engine['pages'].error()
+            await asyncio.sleep(backoff(attempt))
+        except BaseException: # (cancelled, or the write failed)
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+            raise
 
-    return new_imgs
+def index_path(path: str) -> str:
+    """path of a page as saved in the index (relative to the folder of the library, like the ones of Converter.py)"""
+    return os.path.relpath(path, libraryRoot) if libraryRoot else path
 
-if not os.path.exists(FOLDER_PATH):
-    os.makedirs(FOLDER_PATH)
+def add_page(idChapter: str, page: int, filename: str, path: str, size: int, mtime: float = None):
+    """
+    records a saved page in the index, or once its cbz is closed if it is in one (until then it is only in the .cbz.part,
+    so a page indexed before would be skipped after a crash while the cbz doesn't have it)
+    """
+    if Storage.cbz_entry(path):
+        cbzPages.setdefault(idChapter, []).append((page, filename, path, mtime is not None))
+    else:
+        index.add_page(idChapter, page, filename, index_path(path), size, mtime)
 
-print("============================================")
-print(f"Mangadex Downloader/Sync script v{__VERSION__}")
-print(f"By {__AUTHOR__}")
-print("============================================")
+def close_chapter(idChapter: str, path: str):
+    """closes the cbz of a chapter if it has one (path : path of one of its pages) and records its pages in the index"""
+    Storage.close_chapter(path)
+    for (page, filename, path, checked) in cbzPages.pop(idChapter, ()):
+        st = Storage.stat(path)
+        if st:
+            index.add_page(idChapter, page, filename, index_path(path), st[0], st[1] if checked else None)
 
-# LOGIN ===========================
-account = Account() 
-if os.path.exists(LOGIN_PATH):
-    with io.open(LOGIN_PATH, 'r') as file:
-        content = file.read()
+async def write_page(tmp: str, path: str) -> tuple[int, float]:
+    """called for each downloaded page by the engine, saves it in a thread (output : (size, mtime) of the page)"""
+    with metrics.timer("page_write_seconds"):
+        return await asyncio.to_thread(Storage.write_page, tmp, path)
+
+# SESSION =========================
+# shared by the stages of the engine, set by open_session (kept between the cycles of the watch mode)
+index: ArchiveIndex = None # pages and chapters already in the archive
+cbzPages: dict[str, list] = {} # idChapter : pages saved in its open cbz, indexed once it is closed (see add_page)
+account: Account = None
+pool: ClientPool = None # keep-alive clients, shared by every stage
+atHome: AtHomeCache = None # M@H servers of the chapters
+nodes: NodeHealth = None # health of the M@H nodes
+engine: Engine = None
+prgbar = None # rich.progress.Progress of the sync
+metrics: Metrics = None # shared with the pool, written at the end of each run
+metricsPath = METRICS_PATH
+libraryRoot = "" # folder of the library (see set_library), the paths saved in the index are relative to it
+prometheusPath = PROMETHEUS_PATH
+
+def load_account(interactive: bool = True) -> Account:
+    """
+    logs in with the tokens saved in LOGIN_PATH (refreshed if needed)
+    param : interactive : bool : asks for the credentials if there are no tokens (else continues without login)
+    """
+    account = Account(LOGIN_PATH, interactive=interactive)
+    if os.path.exists(LOGIN_PATH):
+        with io.open(LOGIN_PATH, 'r') as file:
+            content = file.read()
         if content: # token found
             print('[bold green]login tokens found...')
             tokens = json.loads(content)
-            token = tokens['token']
-            refresh_token = tokens['refresh_token']
-            account.relogin(token, refresh_token)
-        else:
-            print('[bold red]Invalid token file, need to login again :')
+            account.relogin(tokens['token'], tokens['refresh_token'])
+            return account
+        print('[bold red]Invalid token file' + (', need to login again :' if interactive else ''))
+        if interactive:
             account.login()
-else:
-    print('[bold red]No login token found...')
-    confirm = input("Do you want to login (y/N) ? ")
-    if confirm == 'y':
-        account.login()
-#print(account.bearer)
-# LOGIN ==========================
-
-choices = input("[S]earch for a new manga // [U]pdate existant one // [V]erify folder state \n\t(S/U/V) ([V]erify only by default) ? "
-                ).split(' ')
-newSync = (1 if "S" in choices else 0)
-isUpdate = (1 if "U" in choices else 0)
-
-# User interaction
-if newSync: # Search for a new manga and ask for storage choices
-    print("============================================")
-    print("Search type :")
-    print("\t- 0 : Search engine")
-    print("\t- 1 : Link to manga page")
-    print("\t- 2 : Import user follows (login required)")
-    print("============================================")
-    choice = input("Choice (0, 1 or 2 // default is 0) : ")
-    while not (choice == '0' or choice == '1' or (choice == '2' and not account.isExpired)):
-        if choice == '2':
-            print('[bold red]Not logged in')
-        else:    
-            print('[bold red]Choice is invalid')
-        choice = input("Choice (0, 1 or 2 // default is 0) : ")
-
-    isLink = False
-    isFollows = False
-    if choice == '1':
-        isLink = True
-        isFollows = False
-    elif choice == '2':
-        isLink = False
-        isFollows = True
-    
-    if isLink: # links to page (need to get the page)
-        links = input("Adress(es) to manga(s) (espaces between each adresses/ids) : ")
-        ids = [link.split('/')[-2] if len(link) > 36 else link for link in links.split(' ')]
-        payload = {
-            "limit": 9, # numbers of results to choose from (9 by default : 10 results)
-            "offset": 0,
-            "ids[]": ids,
-            "contentRating[]": [
-                "safe",
-                "suggestive",
-                "erotica",
-                "pornographic"
-            ]
-        }
-    
-    elif isFollows: # import of user follows
-        payload = {
-            'limit': 9,
-            'offset': 0
-        }
-    
-    else: # search engine
-        title = input("Search title : ")
-        payload = {
-            "title": title,
-            "limit": 9, # numbers of results to choose from (9 by default : 10 results)
-            "offset": 0,
-            "contentRating[]": [
-                "safe",
-                "suggestive",
-                "erotica",
-                "pornographic"
-            ],
-            "hasAvailableChapters": "1",
-            "order[relevance]": "desc"
-            # tag exemples
-            #"includedTags[]": [
-            #    "423e2eae-a7a2-4a8b-ac03-a8351462d71d", # romance
-            #    "e5301a23-ebd9-49dd-a0cb-2add944c7fe9", # SoL
-            #    "caaa44eb-cd40-4177-b930-79d3ef2afe87" # School
-            #]
-            # you can edit this dictionary by adding tags (like above, exemples in tags.json)
-        }
-    def search() -> dict:
-        r = req.get(f"{base}/manga", params=payload)
-        return r.json()
-    def get_follows() -> dict:
-        r = req.get(f"{base}/user/follows/manga", params=payload, headers=account.bearer)
-        assert r.json()['result'] == 'ok', "follows gathering failed"
-        return r.json()
-    
-    if isFollows:
-        data = get_follows()
-    else:
-        data = search()
-    
-    with io.open("search.json", "w+", encoding="UTF-8") as file:
-        json.dump(data, file)
-    
-    page = 1
-    def show_titles(data, info=''):
-        # clear console
-        if os.name == "nt": # for Windows
-            os.system('cls')
-        elif os.name == "posix": # for Linux and Mac
-            os.system('clear')
-        # print info message if there is one
-        if info:
-            print('[bold red] Already at {}'.format(info))
-        print("============================================")
-        print("[bold blue]PAGE {}".format(page))
-        print(f"Search results... (results {data['offset']+1} to {data['offset']+data['limit']})")
-        if data['data']: # results found
-            for i in range(len(data['data'])):
-                title = data['data'][i]["attributes"]["title"]["en"] if "en" in data['data'][i]["attributes"]["title"].keys() else list(data['data'][i]["attributes"]["title"].values())[0]
-                print(f"\t{i+1} : {title}")
-        else: # no results found
-            print("\t[bold red]No results !")
-        print("============================================")
-    
-    # Search choice
-    show_titles(data)
-    mChoice = input(f"Choice (all if empty // space between values // +/- to change page): ")
-    while mChoice in ('+', '-'): # page change
-        info = ''
-        page += 1 if mChoice == '+' else -1
-        if page < 1: 
-            page = 1
-            info = 'first page'
-        if not data['data'] and mChoice == '+':
-            page -= 1
-            info = 'last page'
-        else:
-            payload['offset'] = (page - 1) * payload['limit']
-            if isFollows:
-                data = get_follows()
-            else:
-                data = search()
-        show_titles(data, info)
-        mChoice = input(f"Choice (all if empty // space between values // +/- to change page): ")
-    if mChoice:  
-        try:
-            mList = [data["data"][int(i)-1] for i in mChoice.split(" ")]
-        except Exception:
-            print("[bold red]Invalid choice")
-            exit()
-    else:
-        mList = data["data"]
-    
-    print("============================================")
-    print("[bold green]File system :")
-    print("\t- 0 : vol/chap/page.* : \n\t\teasier to browse but harder to read chapters")
-    print("\t- 1 : vol/chap-page.* : \n\t\teasier to read chapters but harder to browse")
-    print("============================================")
-    fsChoice = input("Choice (0 or 1) : ")
-    try:
-        fsChoice = int(fsChoice)
-    except Exception:
-        print("[bold red]Invalid choice")
-        exit()
-    # ask for file quality if the script doesn't stop after search
-    print("============================================")
-    print("[bold green]File quality :[/bold green]")
-    print("\t- 0 : jpg files (compressed) : smaller by around 20-30%")
-    print("\t- 1 : png files (orginal quality) : normal size")
-    print("============================================")
-    qChoice = input("Choice (0 or 1) : ")
-    try:
-        qChoice = int(qChoice)
-    except Exception:
-        print("[bold red]Invalid choice")
-        exit()
-
-else: # Ask which manga(s) must be updated
-    folderList = [f for f in os.listdir(os.path.join(FOLDER_PATH)) if os.path.isdir(os.path.join(FOLDER_PATH, f)) and "infos.json" in os.listdir(os.path.join(FOLDER_PATH, f))]
-    if not folderList: # if no folders have been found
-        print("[bold red]No mangas found in working directory !")
-        exit()
-    print("============================================")
-    print("Manga choice :")
-    for i in range(len(folderList)):
-        print(f"\t{i} : {folderList[i]}")
-    print("============================================")
-    mChoice = input(f"Choice (all if empty) (space between values): ")
-    if not mChoice:
-        mList = folderList
     else:
+        print('[bold red]No login token found...')
+        if interactive and input("Do you want to login (y/N) ? ") == 'y':
+            account.login()
+    return account
+
+def set_library(root: str):
+    """
+    folder of the archive and login.json of the next sessions (FOLDER_PATH and LOGIN_PATH of Globals are relative to it,
+    the index and the metrics are in the archive), so the working directory of the process is never used nor changed (Library.py)
+    """
+    global libraryRoot, FOLDER_PATH, LOGIN_PATH, metricsPath
+    libraryRoot = root
+    FOLDER_PATH = os.path.join(root, Globals.FOLDER_PATH)
+    LOGIN_PATH = os.path.join(root, Globals.LOGIN_PATH)
+    metricsPath = os.path.join(FOLDER_PATH, os.path.basename(METRICS_PATH))
+
+def open_session(interactive: bool = True, mangas: int = SIMULTANEOUS_MANGAS, chapters: int = SIMULTANEOUS_REQUESTS,
+                 pages: int = SIMULTANEOUS_PAGES, clientPool: ClientPool = None, adaptive: bool = ADAPTIVE_CONCURRENCY):
+    """
+    opens the index, logs in and creates the engine (one event loop : mangas -> chapters -> pages -> writes)
+    param : chapters, pages : int : chapters and pages in progress at the same time (at the start if adaptive)
+    param : clientPool : ClientPool : used for every request (a new one if None)
+    param : adaptive : bool : the chapters and pages in progress are adapted to the throughput and errors (AIMD)
+    """
+    global index, account, pool, atHome, nodes, engine, prgbar, metrics
+    os.makedirs(FOLDER_PATH, exist_ok=True)
+    index = ArchiveIndex(os.path.join(FOLDER_PATH, os.path.basename(INDEX_PATH)))
+    account = load_account(interactive)
+    pool = clientPool if clientPool else ClientPool()
+    # bearer in the headers of the api client, updated when the token is refreshed
+    pool.set_headers(base, account.bearer)
+    account.on_tokens = lambda bearer: pool.set_headers(base, bearer)
+    metrics = pool.metrics
+    atHome = AtHomeCache(pool)
+    nodes = NodeHealth(pool)
+    engine = Engine()
+    engine.add_stage('mangas', get_manga, mangas)
+    # (a chapter lasts as long as its pages : its latency depends on the pages stage, so only its errors are checked)
+    # one scheduler by stage for the whole library : global cap (workers or limit), fair share and priority by manga
+    engine.add_stage('chapters', get_chapter_data, chapters,
+                     limit=AdaptiveLimit(chapters, 1, max(chapters, MAX_SIMULTANEOUS_REQUESTS), latencyFactor=0) if adaptive else None,
+                     perKey=SIMULTANEOUS_CHAPTERS_BY_MANGA)
+    engine.add_stage('pages', get_page, pages, max(QUEUE_SIZE, pages),
+                     limit=AdaptiveLimit(pages, 1, max(pages, MAX_SIMULTANEOUS_PAGES)) if adaptive else None)
+    engine.add_stage('writes', write_page, WRITE_WORKERS, WRITE_QUEUE_SIZE)
+    from rich.progress import Progress # progress bar
+    prgbar = Progress(disable=not (interactive or sys.stdout.isatty())) # no progress bar in logs (cron)
+
+def export_metrics():
+    """writes the metrics of the session (json, and Prometheus text file if prometheusPath is set)"""
+    if metricsPath:
+        metrics.write_json(metricsPath)
+    if prometheusPath:
+        metrics.write_prometheus(prometheusPath)
+
+async def close_session():
+    """closes the clients and the index (must be called in the event loop that used them)"""
+    account.stop_refresh()
+    atHome.clear()
+    await nodes.aclose()
+    await pool.aclose()
+    index.close()
+
+async def run_sync(jobs: list, update: bool = False) -> list:
+    """
+    syncs the mangas (args of get_manga, from get_param_manga)
+    param : update : bool : new chapters of the whole library are found first in a few requests (mangas synced before)
+
+    output : list : result (or exception) of each manga
+    """
+    if account.isExpiring: # the event loop was idle (between two calls of Library.py) : refreshed before the first request
+        import requests as req
         try:
-            mList = [folderList[int(i)] for i in mChoice.split(" ")]
-        except Exception:
-            print("[bold red]Invalid choice")
-            exit()
-    
+            await account.refresh()
+        except (req.RequestException, AssertionError, KeyError) as e:
+            print(f"[bold red]token refresh failed : {e}")
+    account.start_refresh()
+    # taken before any request, so a chapter updated while the mangas wait in the queue is found by the next sync
+    syncStart = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+    if update:
+        jobs = await discover_chapters(jobs)
+    return await engine.run('mangas', [job[:7] + (syncStart,) for job in jobs])
+# SESSION =========================
+
+def library() -> list[str]:
+    """folders of the mangas of the archive (with an infos.json)"""
+    return [f for f in os.listdir(FOLDER_PATH) if os.path.isdir(os.path.join(FOLDER_PATH, f)) and "infos.json" in os.listdir(os.path.join(FOLDER_PATH, f))]
+
+def verify_library(mList: list) -> int:
+    """
+    checks the pages of the mangas (hashed in parallel, only the ones changed since their last check) and their infos.json
+    output : int : number of changes made to infos.json files
+    """
+    report = verify_pages(index, [idManga for idManga in (index.manga_id(m) for m in mList) if idManga], root=libraryRoot)
+    for path in report['missing'] + report['corrupt']:
+        print(f"[bold red]{'Missing' if path in report['missing'] else 'Corrupt'} page (will be downloaded again) : {path}")
+    print('[bold blue]Integrity : {} missing and {} corrupt pages'.format(len(report['missing']), len(report['corrupt'])))
     nChanges = 0
     for m in mList:
         if not os.path.isdir(os.path.join(FOLDER_PATH, m, "chapters")):
             os.mkdir(os.path.join(FOLDER_PATH, m, "chapters"))
-        chapterList = []
-        for vol in [f for f in os.listdir(os.path.join(FOLDER_PATH, m, "chapters")) if os.path.isdir(os.path.join(FOLDER_PATH, m, "chapters", f))]:
-            volChapList = [chap.split('-')[1] for chap in os.listdir(os.path.join(FOLDER_PATH, m, "chapters", vol))]
-            chapterList.extend(volChapList)
-        chapterList = list(set(chapterList))
-        chapterList.sort(key=lambda c: (float(c) if c != None and c != 'None' else 0))
-        with io.open(os.path.join(FOLDER_PATH, m, "chapters.json"), "r", encoding="UTF-8") as filec:
-            chapters = json.load(filec)
-            chapters = [c for c in chapters if c['attributes']['chapter'] in chapterList]
+        idManga = index.manga_id(m)
+        if idManga: # chapters done are in the index
+            chapterList = index.chapter_list(idManga)
+        else: # manga never synced with the index, walk the folders
+            chapterList = []
+            for vol in [f for f in os.listdir(os.path.join(FOLDER_PATH, m, "chapters")) if os.path.isdir(os.path.join(FOLDER_PATH, m, "chapters", f))]:
+                volChapList = [chap.split('-')[1] for chap in os.listdir(os.path.join(FOLDER_PATH, m, "chapters", vol))]
+                chapterList.extend(volChapList)
+            chapterList = list(set(chapterList))
+            chapterList.sort(key=chapter_order)
+        chapters = [c for c in FeedFile(os.path.join(FOLDER_PATH, m)).scan() if c.chapter in chapterList]
         if os.path.isfile(os.path.join(FOLDER_PATH, m, "infos.json")) and io.open(os.path.join(FOLDER_PATH, m, "infos.json")).read():
             with io.open(os.path.join(FOLDER_PATH, m, "infos.json"), "r+", encoding="UTF-8") as file:
                 mangaInfos = json.load(file)
@@ -603,6 +710,7 @@ else: # Ask which manga(s) must be updated
                 nChanges += 1
             elif chapterList != mangaInfos['chapterList']:
                 mangaInfos['chapterList'] = chapterList
+                mangaInfos.pop('lastSync', None) # next update gets the whole feed again (for the missing chapters)
                 nChanges += 1
             with io.open(os.path.join(FOLDER_PATH, m, "infos.json"), "w+", encoding="UTF-8") as file:
                 json.dump(mangaInfos, file)
@@ -610,8 +718,13 @@ else: # Ask which manga(s) must be updated
             chapter_path = os.path.join(FOLDER_PATH, m , 'chapters')
             vol_1 = os.path.join(chapter_path, os.listdir(chapter_path)[0])
             chap_1 = os.path.join(vol_1, os.listdir(vol_1)[0])
-            fSys = 1 if os.path.isfile(chap_1) else 0
-            if fSys: # vol/chap-page
+            fSys = (Storage.CBZ if chap_1.endswith('.cbz') else 1) if os.path.isfile(chap_1) else 0
+            if fSys == Storage.CBZ: # vol/chap.cbz
+                if list(Storage.cbz_pages(chap_1))[0].split('.')[-1] == 'png':
+                    Format = 1
+                else:
+                    Format = 0
+            elif fSys: # vol/chap-page
                 if chap_1.split('.')[-1] == 'png':
                     Format = 1
                 else:
@@ -626,24 +739,23 @@ else: # Ask which manga(s) must be updated
                 mangaInfos = {
                     "fileSys" : fSys,
                     "format" : Format,
-                    "id": [r['id'] for r in chapters[0]["relationships"] if r['type'] == 'manga'][0],
+                    "id": chapters[0].manga,
                     "name" : m,
                     "chapterList": chapterList,
                 }
                 json.dump(mangaInfos, file)
             nChanges += 1
     print('[bold blue]Verification : {} changes to infos.json files have been made'.format((nChanges if nChanges else 'No')))
-    if not isUpdate:
-        exit()
-        
-# create progress bar for mangas
-prgbar = Progress()
-prgbar.start()
-start = perf_counter()
-# for each manga
+    return nChanges
+
 def get_param_manga(m, fsChoice='', qChoice=''):
-    if newSync:
+    """
+    args of get_manga for a manga
+    param : m : dict (result of a search : new manga, infos.json is created) or str (folder of a manga already synced)
+    """
+    if isinstance(m, dict):
         presentChapters = []
+        lastSync = "" # whole feed
         idManga = m["id"]
         name = format_title(m["attributes"]["title"]["en"] if "en" in m["attributes"]["title"].keys() else list(m["attributes"]["title"].values())[0])
         if name not in os.listdir(FOLDER_PATH):
@@ -667,16 +779,11 @@ def get_param_manga(m, fsChoice='', qChoice=''):
         idManga = mangaInfos["id"]
         qChoice = mangaInfos["format"]
         fsChoice = mangaInfos["fileSys"]
+        lastSync = mangaInfos.get("lastSync", "")
         if "chapterList" in mangaInfos.keys(): # updated infos.json
             presentChapters = mangaInfos["chapterList"]
         else: # old infos.json, need to add present chapters
-            with io.open(os.path.join(FOLDER_PATH, name, "chapters.json"), "r", encoding="UTF-8") as file:
-                chapters = json.load(file)   
-                chapters.sort(key=lambda c: (float(c["attributes"]["chapter"]) 
-                                    if c["attributes"]["chapter"] != None 
-                                    else 0))      
-                presentChapters = list(set([chapter["attributes"]["chapter"] for chapter in chapters]))
-                presentChapters.sort(key=lambda c: (float(c) if c != None else 0))
+            presentChapters = sorted(set([chapter.chapter for chapter in FeedFile(os.path.join(FOLDER_PATH, name)).scan()]), key=chapter_order)
             with io.open(os.path.join(FOLDER_PATH, name, "infos.json"), "w+", encoding="UTF-8") as file:
                 mangaInfos = {
                     "fileSys" : fsChoice,
@@ -687,18 +794,325 @@ def get_param_manga(m, fsChoice='', qChoice=''):
                 }
                 json.dump(mangaInfos, file)
     
-    return fsChoice, qChoice, idManga, name, presentChapters
+    return fsChoice, qChoice, idManga, name, presentChapters, lastSync, None
 
-manga_tasks = [Thread(target=get_manga, args=get_param_manga(m, fsChoice, qChoice) if newSync 
-                    else get_param_manga(m)) for m in mList]
-for task in manga_tasks:
-    task.start()
+def get_mangas_by_id(ids: list) -> list:
+    """search results (json) of the mangas with these ids (or links to their pages)"""
+    payload = {
+        "limit": 100,
+        "offset": 0,
+        "ids[]": [link.split('/')[-2] if len(link) > 36 else link for link in ids],
+        "contentRating[]": [
+            "safe",
+            "suggestive",
+            "erotica",
+            "pornographic"
+        ]
+    }
+    import requests as req
+    rep = req.get(f"{base}/manga", params=payload)
+    return rep.json()['data']
 
-while any([task.is_alive() for task in manga_tasks]):
-    sleep(.5)
+async def sync_mangas(mList: list, fsChoice='', qChoice='', update: bool = False) -> list:
+    """syncs the mangas (folders of mangas already synced, or search results) and prints the failed ones, output : results of run_sync"""
+    prgbar.start()
+    start = perf_counter()
+    results = await run_sync([get_param_manga(m, fsChoice, qChoice) for m in mList], update)
+    for m, result in zip(mList, results):
+        if isinstance(result, Exception):
+            print(f"[bold red]Sync of {m if isinstance(m, str) else m['id']} failed : {result}")
+    prgbar.refresh()
+    prgbar.stop()
+    for taskId in list(prgbar.task_ids): # next cycle of the watch mode starts with an empty progress bar
+        prgbar.remove_task(taskId)
+    stop = perf_counter()
+    execution_time = round(stop - start, 3)
+    print(f"temps d'éxecution : {execution_time}s")
+    for stage in engine.stages.values():
+        metrics.set("concurrency_limit", stage.limit.limit if stage.limit else stage.workers, stage=stage.name)
+    export_metrics()
+    return results
+
+async def watch(titles: list = None, interval: float = WATCH_INTERVAL):
+    """
+    watch mode : updates the library every interval seconds, with the same clients, token and index for every cycle
+    param : titles : list : folders of the mangas to update (the whole library, read again at each cycle, if None)
+    """
+    while True:
+        print(f"[bold blue]{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} : sync of the library")
+        try:
+            await sync_mangas(titles if titles is not None else library(), update=True)
+        except (httpx.HTTPError, OSError) as e: # network down... : tried again at the next cycle
+            print(f"[bold red]Sync failed (next try in {interval}s) : {e}")
+        index.commit()
+        await asyncio.sleep(interval)
+
+def interactive():
+    """sync driven by the console (search, update or verify)"""
+    open_session()
+    choices = input("[S]earch for a new manga // [U]pdate existant one // [V]erify folder state \n\t(S/U/V) ([V]erify only by default) ? "
+                    ).split(' ')
+    newSync = (1 if "S" in choices else 0)
+    isUpdate = (1 if "U" in choices else 0)
+    fsChoice, qChoice = '', ''
+
+    # User interaction
+    if newSync: # Search for a new manga and ask for storage choices
+        print("============================================")
+        print("Search type :")
+        print("\t- 0 : Search engine")
+        print("\t- 1 : Link to manga page")
+        print("\t- 2 : Import user follows (login required)")
+        print("============================================")
+        choice = input("Choice (0, 1 or 2 // default is 0) : ")
+        while not (choice == '0' or choice == '1' or (choice == '2' and not account.isExpired)):
+            if choice == '2':
+                print('[bold red]Not logged in')
+            else:    
+                print('[bold red]Choice is invalid')
+            choice = input("Choice (0, 1 or 2 // default is 0) : ")
+
+        isLink = False
+        isFollows = False
+        import Search # search engine, links and follows (cached)
+        from rich.console import Console # clear of the console
+        searchCache = Search.SearchCache(os.path.join(FOLDER_PATH, ".cache"))
+        console = Console()
+        if choice == '1':
+            isLink = True
+            isFollows = False
+        elif choice == '2':
+            isLink = False
+            isFollows = True
+        
+        if isLink: # links to page (need to get the page)
+            links = input("Adress(es) to manga(s) (espaces between each adresses/ids) : ")
+            ids = [link.split('/')[-2] if len(link) > 36 else link for link in links.split(' ')]
+            payload = {
+                "limit": 9, # numbers of results to choose from (9 by default : 10 results)
+                "offset": 0,
+                "ids[]": ids,
+                "contentRating[]": [
+                    "safe",
+                    "suggestive",
+                    "erotica",
+                    "pornographic"
+                ]
+            }
+        
+        elif isFollows: # import of user follows
+            payload = {
+                'limit': 9,
+                'offset': 0
+            }
+        
+        else: # search engine
+            title = input("Search title : ")
+            tagNames = input("Tags (names separated by commas, none if empty) : ")
+            payload = {
+                "title": title,
+                "limit": 9, # numbers of results to choose from (9 by default : 10 results)
+                "offset": 0,
+                "contentRating[]": [
+                    "safe",
+                    "suggestive",
+                    "erotica",
+                    "pornographic"
+                ],
+                "hasAvailableChapters": "1",
+                "order[relevance]": "desc"
+            }
+            if tagNames.strip(): # ids of the tags (list of MangaDex, requested once)
+                tagIds = Search.tags(searchCache)
+                names = [n.strip().lower() for n in tagNames.split(",") if n.strip()]
+                for n in names:
+                    if n not in tagIds:
+                        print(f"[bold red]Unknown tag : {n}")
+                payload["includedTags[]"] = [tagIds[n] for n in names if n in tagIds]
+        # pages of results (cached on disk, the next one is requested while the current one is read)
+        if isFollows:
+            pager = Search.Pager(searchCache, f"{base}/user/follows/manga", payload, {'Authorization': 'Bearer ' + account.token}) # (refreshed if expired)
+        else:
+            pager = Search.Pager(searchCache, f"{base}/manga", payload)
+        page = 1
+        data = pager.get(page)
+
+        def show_titles(data, info=''):
+            console.clear()
+            # print info message if there is one
+            if info:
+                print('[bold red] Already at {}'.format(info))
+            print("============================================")
+            print("[bold blue]PAGE {}".format(page))
+            print(f"Search results... (results {data['offset']+1} to {data['offset']+data['limit']})")
+            if data['data']: # results found
+                for i in range(len(data['data'])):
+                    title = data['data'][i]["attributes"]["title"]["en"] if "en" in data['data'][i]["attributes"]["title"].keys() else list(data['data'][i]["attributes"]["title"].values())[0]
+                    print(f"\t{i+1} : {title}")
+            else: # no results found
+                print("\t[bold red]No results !")
+            print("============================================")
+        
+        # Search choice
+        show_titles(data)
+        mChoice = input(f"Choice (all if empty // space between values // +/- to change page): ")
+        while mChoice in ('+', '-'): # page change
+            info = ''
+            if mChoice == '-' and page == 1:
+                info = 'first page'
+            elif mChoice == '+' and pager.is_last(page, data):
+                info = 'last page'
+            else:
+                page += 1 if mChoice == '+' else -1
+                data = pager.get(page)
+            show_titles(data, info)
+            mChoice = input(f"Choice (all if empty // space between values // +/- to change page): ")
+        pager.close()
+        if mChoice:  
+            try:
+                mList = [data["data"][int(i)-1] for i in mChoice.split(" ")]
+            except Exception:
+                print("[bold red]Invalid choice")
+                exit()
+        else:
+            mList = data["data"]
+        
+        print("============================================")
+        print("[bold green]File system :")
+        print("\t- 0 : vol/chap/page.* : \n\t\teasier to browse but harder to read chapters")
+        print("\t- 1 : vol/chap-page.* : \n\t\teasier to read chapters but harder to browse")
+        print("\t- 2 : vol/chap.cbz : \n\t\tone file by chapter (for comic readers, faster to backup and verify)")
+        print("============================================")
+        fsChoice = input("Choice (0, 1 or 2) : ")
+        try:
+            fsChoice = int(fsChoice)
+            assert fsChoice in Storage.FILE_SYSTEMS
+        except Exception:
+            print("[bold red]Invalid choice")
+            exit()
+        # ask for file quality if the script doesn't stop after search
+        print("============================================")
+        print("[bold green]File quality :[/bold green]")
+        print("\t- 0 : jpg files (compressed) : smaller by around 20-30%")
+        print("\t- 1 : png files (orginal quality) : normal size")
+        print("============================================")
+        qChoice = input("Choice (0 or 1) : ")
+        try:
+            qChoice = int(qChoice)
+        except Exception:
+            print("[bold red]Invalid choice")
+            exit()
+
+    else: # Ask which manga(s) must be updated
+        folderList = library()
+        if not folderList: # if no folders have been found
+            print("[bold red]No mangas found in working directory !")
+            exit()
+        print("============================================")
+        print("Manga choice :")
+        for i in range(len(folderList)):
+            print(f"\t{i} : {folderList[i]}")
+        print("============================================")
+        mChoice = input(f"Choice (all if empty) (space between values): ")
+        if not mChoice:
+            mList = folderList
+        else:
+            try:
+                mList = [folderList[int(i)] for i in mChoice.split(" ")]
+            except Exception:
+                print("[bold red]Invalid choice")
+                exit()
+        
+        verify_library(mList)
+        if not isUpdate:
+            index.close()
+            exit()
+
+    async def sync():
+        try:
+            await sync_mangas(mList, fsChoice, qChoice, isUpdate)
+        finally:
+            await close_session()
+    asyncio.run(sync())
+
+def headless(args):
+    """sync driven by the command line arguments (never asks anything, for cron or a service)"""
+    global metricsPath, prometheusPath
+    metricsPath = args.metrics
+    prometheusPath = args.prometheus
+    open_session(False, args.mangas, args.chapters, args.pages, adaptive=args.adaptive)
+    folderList = library()
+    if args.titles and args.titles != ['all']:
+        unknown = [m for m in args.titles if m not in folderList]
+        if unknown:
+            print(f"[bold red]Mangas not found in {FOLDER_PATH} : {', '.join(unknown)}")
+        titles = [m for m in args.titles if m in folderList]
+        if not titles: # (never the whole library when the mangas given are all unknown)
+            index.close()
+            sys.exit(1)
+    else:
+        titles = None # whole library
+    if args.verify:
+        verify_library(titles if titles is not None else folderList)
+
+    async def sync():
+        try:
+            if args.add: # new mangas
+                await sync_mangas(get_mangas_by_id(args.add), args.layout, args.quality)
+            if args.watch:
+                await watch(titles, args.watch)
+            elif args.update:
+                await sync_mangas(titles if titles is not None else library(), update=True)
+        finally:
+            await close_session()
+    if args.add or args.update or args.watch:
+        asyncio.run(sync())
+    else:
+        index.close()
+
+def parse_args(argv: list = None) -> argparse.Namespace:
+    """
+    arguments of the headless mode (the values of a --config json file are used as defaults, ex : {"update": true, "titles": ["all"]})
+    """
+    parser = argparse.ArgumentParser(description="MangaDex sync, without arguments the sync is interactive")
+    parser.add_argument("titles", nargs="*", help="folders of the mangas to update or verify (all if empty or 'all')")
+    parser.add_argument("--config", help="json file with the default values of these arguments")
+    parser.add_argument("--library", help="folder where the archive and login.json are (working directory by default)")
+    parser.add_argument("-u", "--update", action="store_true", help="update the mangas")
+    parser.add_argument("-v", "--verify", action="store_true", help="verify the pages and infos.json of the mangas first")
+    parser.add_argument("-a", "--add", nargs="+", metavar="ID", help="new mangas to sync (ids or links to their pages)")
+    parser.add_argument("-q", "--quality", type=int, choices=(0, 1), default=1, help="new mangas : 0 : jpg (compressed), 1 : png (original)")
+    parser.add_argument("-l", "--layout", type=int, choices=sorted(Storage.FILE_SYSTEMS), default=1,
+                        help="new mangas : " + ", ".join(f"{i} : {fs}" for i, fs in Storage.FILE_SYSTEMS.items()))
+    parser.add_argument("-w", "--watch", type=float, nargs="?", const=WATCH_INTERVAL, metavar="SECONDS",
+                        help=f"keep running and update the library every SECONDS (default {WATCH_INTERVAL})")
+    parser.add_argument("--metrics", default=METRICS_PATH, help="json report of the run ('' to disable)")
+    parser.add_argument("--prometheus", default=PROMETHEUS_PATH, help="Prometheus text file written at the end of each run")
+    parser.add_argument("--mangas", type=int, default=SIMULTANEOUS_MANGAS, help="mangas synced at the same time")
+    parser.add_argument("--chapters", type=int, default=SIMULTANEOUS_REQUESTS, help="chapters in progress at the same time (at the start if adaptive)")
+    parser.add_argument("--pages", type=int, default=SIMULTANEOUS_PAGES, help="pages downloaded at the same time (at the start if adaptive)")
+    parser.add_argument("--adaptive", action=argparse.BooleanOptionalAction, default=ADAPTIVE_CONCURRENCY,
+                        help="adapt the chapters and pages in progress to the throughput and errors")
+    args = parser.parse_args(argv)
+    if args.config:
+        with io.open(args.config, "r", encoding="UTF-8") as file:
+            parser.set_defaults(**json.load(file))
+        args = parser.parse_args(argv)
+    return args
+
+def main(argv: list = None):
+    argv = sys.argv[1:] if argv is None else argv
+    print("============================================")
+    print(f"Mangadex Downloader/Sync script v{__VERSION__}")
+    print(f"By {__AUTHOR__}")
+    print("============================================")
+    if not argv:
+        interactive()
+        return
+    args = parse_args(argv)
+    if args.library:
+        os.chdir(args.library) # FOLDER_PATH and LOGIN_PATH are relative to it
+    headless(args)
 
-stop = perf_counter()
-execution_time = round(stop - start, 3)
-print(f"temps d'éxecution : {execution_time}s")
-prgbar.refresh()
-prgbar.stop()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Integrity check of the pages of the archive, used by Sync.py ([V]erify mode and downloads) :
+    - the filenames given by M@H (data / dataSaver) contain the SHA-256 of the page, saved in the index with each page
+    - pages changed since their last check (size or mtime) are hashed again in a process pool (uses all the cores)
+    - missing and corrupt pages are marked in the index and removed, so their chapters are downloaded again by the next update
+"""
+
+import os # paths of the index (relative to the library)
+import hashlib # sha256 of the pages
+import re # hash in the filenames
+from concurrent.futures import ProcessPoolExecutor # hash pages on all the cores
+import Storage # pages in folders or cbz
+from Globals import CHUNK_SIZE, VERIFY_WORKERS
+
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+
+class CorruptPageError(Exception):
+    """the content of a page doesn't match the hash of its filename"""
+
+
+def filename_hash(filename: str) -> str:
+    """SHA-256 contained in a M@H filename ('' if there is none)"""
+    found = HASH_PATTERN.search(filename or "")
+    return found.group(0) if found else ""
+
+def hash_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with Storage.open_page(path) as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def check_page(args) -> tuple:
+    """
+    called in the process pool for each page to hash
+    args : (chapter, page, filename, path, mtime) : row of the index
+    output : (chapter, page, status, mtime) : status is 'done' or 'corrupt'
+    """
+    (chapter, page, filename, path, mtime) = args
+    expected = filename_hash(filename)
+    if expected and hash_file(path) != expected:
+        return chapter, page, 'corrupt', mtime
+    return chapter, page, 'done', mtime
+
+def verify_pages(index, idMangas: list, workers: int = VERIFY_WORKERS, root: str = "") -> dict[str, list]:
+    """
+    checks the pages of the mangas in the index (only the ones changed since their last check are hashed)
+    param : index : ArchiveIndex
+    param : idMangas : list[str] : ids of the mangas to check
+    param : root : str : folder of the library (the paths of the index are relative to it, the working directory if empty)
+
+    output : dict : {'missing': [...], 'corrupt': [...]} paths of the pages that will be downloaded again
+    """
+    report = {'missing': [], 'corrupt': []}
+    toHash = []
+    for (chapter, page, filename, path, size, mtime) in index.pages_to_verify(idMangas):
+        path = os.path.join(root, path) if path else path
+        stat = Storage.stat(path) if path else None
+        if stat is None:
+            index.page_status(chapter, page, 'missing')
+            report['missing'].append(path)
+            continue
+        if stat == (size, mtime): # unchanged since its last check
+            continue
+        toHash.append((chapter, page, filename, path, stat[1]))
+    if toHash:
+        paths = {(chapter, page): path for (chapter, page, _, path, _) in toHash}
+        with ProcessPoolExecutor(max_workers=workers if workers else None) as executor:
+            for (chapter, page, status, mtime) in executor.map(check_page, toHash, chunksize=64):
+                if status == 'done':
+                    index.page_verified(chapter, page, Storage.stat(paths[(chapter, page)])[0], mtime)
+                else:
+                    Storage.remove(paths[(chapter, page)])
+                    index.page_status(chapter, page, status)
+                    report['corrupt'].append(paths[(chapter, page)])
+    index.commit()
+    return report